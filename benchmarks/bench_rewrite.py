@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Micro-benchmark of the request rewriting done by a rewrite rule
+on a routed request.
+
+Run it with the Python interpreter of your buildout::
+
+  $ bin/zopepy benchmarks/bench_rewrite.py
+"""
+
+import timeit
+import urlparse
+
+from ZPublisher.HTTPRequest import HTTPRequest
+from ZPublisher.HTTPResponse import HTTPResponse
+
+from silva.app.forest.service import RewriteRule, RewriteTarget
+
+NUMBER = 100000
+
+
+def make_rule():
+    target = RewriteTarget('/docs', ('root', 'docs'), None, False)
+    return RewriteRule(target, 'http://infrae.com')
+
+
+def make_request():
+    environ = {
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/docs/admin/index'}
+    request = HTTPRequest(None, environ, HTTPResponse())
+    request['ACTUAL_URL'] = request['URL'] + environ['PATH_INFO']
+    return request
+
+
+def legacy_rewrite_request(rule, request):
+    # Implementation used before rewrite_request.
+    request['URL'] = rule.url
+    request['ACTUAL_URL'] = rule.server_url + urlparse.urlunparse(
+        ('', '') + urlparse.urlparse(request['ACTUAL_URL'])[2:])
+    request['SERVER_URL'] = str(rule.server_url)
+    request._script = list(rule.server_script)
+    request._resetURLS()
+
+
+def rewrite_request(rule, request):
+    rule.rewrite_request(request)
+
+
+def bench(function):
+    rule = make_rule()
+    request = make_request()
+    timer = timeit.Timer(lambda: function(rule, request))
+    best = min(timer.repeat(3, NUMBER))
+    return best * 1000000 / NUMBER
+
+
+if __name__ == '__main__':
+    for function in (legacy_rewrite_request, rewrite_request):
+        print '%-25s %6.2f usec per request' % (
+            function.__name__, bench(function))
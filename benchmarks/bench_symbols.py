@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Compare the memory used by a compiled table of 5000 virtual hosts
+having 2 aliases and 20 rewrites each, and the size of its pickle,
+with and without a shared symbol table.
+
+Run it with the Python interpreter of your buildout::
+
+  $ bin/zopepy benchmarks/bench_symbols.py
+"""
+
+import cPickle
+import sys
+
+from zope.interface import implementer
+from OFS.interfaces import IObjectManager
+
+from silva.app.forest.service import VirtualHost, Rewrite
+from silva.app.forest.utils import SymbolTable
+
+
+@implementer(IObjectManager)
+class Folder(object):
+    """Container containing itself with any name, so all the rewrite
+    paths are valid.
+    """
+
+    def _getOb(self, name, default=None):
+        return self
+
+
+class NoSymbols(object):
+    """Symbol table that doesn't share anything.
+    """
+
+    def __call__(self, value):
+        return value
+
+    def tuple(self, values):
+        return tuple(values)
+
+
+def make_hosts(hosts=5000, aliases=2, rewrites=20):
+    result = []
+    for host in range(hosts):
+        site = 'site%d' % host
+        result.append(VirtualHost(
+                'http://%s.example.com' % site,
+                ['http://%s.example%d.com' % (site, alias)
+                 for alias in range(aliases)],
+                [Rewrite('/', '/root/sites/%s' % site)] +
+                [Rewrite('/section%d' % rewrite,
+                         '/root/sites/%s/sections/section%d' % (
+                        site, rewrite))
+                 for rewrite in range(1, rewrites)]))
+    return result
+
+
+def build(hosts, symbols):
+    root = Folder()
+    query = {}
+    for host in hosts:
+        for entry in host.build(root, symbols):
+            query[entry.key] = entry
+    return query
+
+
+def sizeof(obj):
+    """Return the memory used by obj and everything it refers to.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (bool, int)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+            stack.extend(obj.__dict__.iterkeys())
+            stack.extend(obj.__dict__.itervalues())
+    return size
+
+
+def run(hosts):
+    for title, symbols in (('without symbols', NoSymbols()),
+                           ('with symbols', SymbolTable())):
+        query = build(hosts, symbols)
+        print '  %-16s memory %6.1f MB, pickle %6.1f MB' % (
+            title,
+            sizeof(query) / (1024.0 * 1024.0),
+            len(cPickle.dumps(query, 1)) / (1024.0 * 1024.0))
+
+
+if __name__ == '__main__':
+    print '5000 hosts, 2 aliases, 20 rewrites'
+    run(make_hosts())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Compare loading the target of a rewrite rule 12 folders deep by
+traversal, like the rules do, with loading it from the oids of the
+traversed folders. Loading from the oids must check that each folder
+is still in its container, which is as much work as traversing.
+
+Run it with the Python interpreter of your buildout::
+
+  $ bin/zopepy benchmarks/bench_traverse.py
+"""
+
+import timeit
+
+import transaction
+from Acquisition import aq_base, aq_parent
+from OFS.Folder import Folder
+from OFS.interfaces import IObjectManager
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from infrae.wsgi.utils import traverse
+
+DEPTH = 12
+NUMBER = 20000
+
+
+def make_database():
+    db = DB(MappingStorage())
+    connection = db.open()
+    application = connection.root()['Application'] = Folder('Application')
+    folder = application
+    path = []
+    for level in range(DEPTH):
+        name = 'folder%d' % level
+        folder._setObject(name, Folder(name))
+        folder = folder._getOb(name)
+        path.append(name)
+    transaction.commit()
+    connection.close()
+    return db, tuple(path)
+
+
+def get_oids(path, content):
+    oids = []
+    step = traverse(path, content)
+    for piece in path:
+        oids.append(step._p_oid)
+        step = aq_parent(step)
+    oids.reverse()
+    return tuple(oids)
+
+
+def load_checked(oids, path, content):
+    # Load each object from its oid, and check it is still in its
+    # container under the same name.
+    jar = content._p_jar
+    for oid, piece in zip(oids, path):
+        child = jar.get(oid)
+        if not IObjectManager.providedBy(content):
+            return None
+        if aq_base(content._getOb(piece, None)) is not child:
+            return None
+        content = child.__of__(content)
+    return content
+
+
+def load_unchecked(oids, path, content):
+    # Not safe: a moved or deleted object is still found.
+    jar = content._p_jar
+    for oid in oids:
+        content = jar.get(oid).__of__(content)
+    return content
+
+
+def bench(function):
+    timer = timeit.Timer(function)
+    best = min(timer.repeat(3, NUMBER))
+    return best * 1000000 / NUMBER
+
+
+if __name__ == '__main__':
+    db, path = make_database()
+    connection = db.open()
+    application = connection.root()['Application']
+    oids = get_oids(path, application)
+    assert (aq_base(load_checked(oids, path, application)) is
+            aq_base(traverse(path, application)))
+    print '%d folders deep' % DEPTH
+    for title, function in (
+        ('traverse', lambda: traverse(path, application)),
+        ('oids, checked', lambda: load_checked(oids, path, application)),
+        ('oids, unchecked', lambda: load_unchecked(oids, path, application))):
+        print '  %-16s %6.2f usec per target' % (title, bench(function))
+    connection.close()
+    db.close()
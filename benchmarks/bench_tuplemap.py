@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Compare memory usage and lookup speed of the routing maps, with a
+configuration of 10000 virtual hosts having 20 rewrites each, and
+with one of deep rewrites.
+
+Run it with the Python interpreter of your buildout::
+
+  $ bin/zopepy benchmarks/bench_tuplemap.py
+"""
+
+import random
+import sys
+import timeit
+
+from silva.app.forest.utils import TupleMap, RadixMap, RadixNode, PrefixMap
+
+MAPS = (TupleMap, RadixMap, PrefixMap)
+LOOKUPS = 100000
+
+
+def make_hosts(hosts=10000, rewrites=20, depth=1):
+    """Return for each host the by_url and by_path keys of its
+    rewrites, like VirtualHostRule would compute them.
+    """
+    result = []
+    for host in range(hosts):
+        keys = []
+        site = 'site%d' % host
+        for rewrite in range(rewrites):
+            if rewrite:
+                sections = tuple(
+                    'section%d' % rewrite for level in range(depth))
+                url_key = (site,) + sections
+                path_key = ('root', 'sites', site, 'sections') + sections
+            else:
+                url_key = (site,)
+                path_key = ('root', 'sites', site)
+            keys.append((url_key, path_key))
+        result.append(keys)
+    return result
+
+
+def build(factory, hosts):
+    maps = []
+    for keys in hosts:
+        by_url = factory()
+        by_path = factory()
+        for number, (url_key, path_key) in enumerate(keys):
+            by_url.add(url_key, number)
+            by_path.add(path_key, number)
+        maps.append((by_url, by_path))
+    return maps
+
+
+def sizeof(obj):
+    """Return the memory used by the containers of obj. Keys and
+    values are shared between implementations and not counted.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, dict):
+            size += sys.getsizeof(obj)
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple)):
+            size += sys.getsizeof(obj)
+            stack.extend(obj)
+        elif isinstance(obj, RadixNode):
+            size += sys.getsizeof(obj)
+            stack.extend([obj.label, obj.children])
+        elif isinstance(obj, MAPS):
+            size += sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+            stack.extend(obj.__dict__.itervalues())
+    return size
+
+
+def bench_lookup(maps, hosts, extra):
+    random.seed(42)
+    queries = []
+    for number in range(LOOKUPS):
+        index = random.randrange(len(hosts))
+        url_key, path_key = random.choice(hosts[index])
+        queries.append((maps[index], url_key + extra))
+
+    def lookup():
+        for (by_url, by_path), key in queries:
+            by_url.get(key, fallback=True)
+
+    best = min(timeit.Timer(lookup).repeat(3, 1))
+    return best * 1000000 / LOOKUPS
+
+
+def run(title, hosts, extra):
+    print title
+    for factory in MAPS:
+        maps = build(factory, hosts)
+        print '  %-10s memory %8.1f MB, lookup %5.2f usec' % (
+            factory.__name__,
+            sizeof(maps) / (1024.0 * 1024.0),
+            bench_lookup(maps, hosts, extra))
+
+
+if __name__ == '__main__':
+    run('10000 hosts, 20 rewrites',
+        make_hosts(), ('page', 'index'))
+    run('1000 hosts, 20 rewrites of depth 8, lookups of depth 16',
+        make_hosts(1000, 20, 8), ('folder',) * 6 + ('page', 'index'))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Compare computing the URLs of 1000 and 10000 contents one by one,
+with a forest IContentURL adapter for each of them, with the batch
+get_urls of the forest virtual hosting. The adapters are created
+directly, without looking them up in the component registry.
+
+Run it with the Python interpreter of your buildout::
+
+  $ bin/zopepy benchmarks/bench_urls.py
+"""
+
+import timeit
+
+from silva.app.forest.absoluteurl import AbsoluteURL
+from silva.app.forest.service import RewriteSet, RewriteTarget
+from silva.app.forest.service import VirtualHostRule
+from silva.app.forest.virtualhosting import VirtualHosting
+
+REPEAT = 5
+
+
+def make_host():
+    targets = [RewriteTarget('/', ('root', 'sites', 'infrae'))]
+    targets.extend(
+        RewriteTarget('/section%d' % section,
+                      ('root', 'sites', 'infrae', 'section%d' % section))
+        for section in range(1, 20))
+    return VirtualHostRule(
+        'http://infrae.com', RewriteSet('http://infrae.com', targets))
+
+
+def make_plugin(host):
+    plugin = VirtualHosting.__new__(VirtualHosting)
+    plugin.host = host
+    plugin.service = None
+    plugin._router = None
+    plugin._paths = {}
+    plugin.urls = {}
+    return plugin
+
+
+class Request(object):
+    """Request only giving the forest virtual hosting plugin.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def get_plugin(self, iface):
+        return self.plugin
+
+
+def make_paths(count):
+    # Contents of 50 folders in each section.
+    paths = []
+    for index in range(count):
+        paths.append((
+                '', 'root', 'sites', 'infrae',
+                'section%d' % (index % 20),
+                'folder%d' % (index % 50),
+                'document%d' % index))
+    return paths
+
+
+def one_by_one(plugin, paths):
+    request = Request(plugin)
+    return [AbsoluteURL(None, request)._url(path) for path in paths]
+
+
+def batch(plugin, paths):
+    return plugin.get_urls(paths)
+
+
+def bench(function, paths):
+    host = make_host()
+
+    def run():
+        # The lookups are remembered for a request only.
+        function(make_plugin(host), paths)
+
+    best = min(timeit.Timer(run).repeat(REPEAT, 1))
+    return best * 1000
+
+
+if __name__ == '__main__':
+    for count in (1000, 10000):
+        paths = make_paths(count)
+        host = make_host()
+        assert (one_by_one(make_plugin(host), paths) ==
+                batch(make_plugin(host), paths))
+        for function in (one_by_one, batch):
+            print '%6d paths %-12s %8.2f msec' % (
+                count, function.__name__, bench(function, paths))
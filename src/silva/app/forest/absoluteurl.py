@@ -6,7 +6,6 @@ import logging
 
 from infrae.wsgi.interfaces import IVirtualHosting
 from silva.app.forest.interfaces import IForestHosting
-from silva.app.forest.utils import url2tuple
 from silva.core.views import absoluteurl
 
 from zExceptions import BadRequest
@@ -23,11 +22,17 @@ class SimpleURL(object):
 
         virtual_host = plugin.host
         if host is not None:
-            virtual_host = plugin.service.query(url2tuple(host))
+            virtual_host = plugin.router.query_url(host)
         if virtual_host is None:
             return super(SimpleURL, self)._url(path, preview, relative, host)
 
-        rule, index = virtual_host.by_path.get(path[1:], fallback=True)
+        path = tuple(path)
+        key = (SimpleURL, virtual_host, path, relative)
+        url = plugin.urls.get(key)
+        if url is not None:
+            return url
+
+        rule, index = plugin.query_path(virtual_host, path[1:])
         if rule is None:
             logger.error(
                 u"No virtual host defined to compute URL for path %s.",
@@ -38,8 +43,11 @@ class SimpleURL(object):
 
         path = list(path[index + 1:])
         if relative:
-            return '/' + '/'.join(rule.server_script + path)
-        return '/'.join([rule.url,] + path)
+            url = '/' + '/'.join(rule.server_script + path)
+        else:
+            url = '/'.join([rule.url,] + path)
+        plugin.urls[key] = url
+        return url
 
 
 class AbsoluteURL(SimpleURL, absoluteurl.AbsoluteURL):
@@ -63,24 +71,35 @@ class ContentURL(object):
 
         virtual_host = plugin.host
         if host is not None:
-            virtual_host = plugin.service.query(url2tuple(host))
+            virtual_host = plugin.router.query_url(host)
         if virtual_host is None:
             return super(ContentURL, self)._url(path, preview, relative, host)
 
-        rule, index = virtual_host.by_path.get(path[1:], fallback=True)
+        path = tuple(path)
+        key = (ContentURL, virtual_host, path, preview is True, relative)
+        url = plugin.urls.get(key)
+        if url is not None:
+            return url
+
+        rule, index = plugin.query_path(virtual_host, path[1:])
         if rule is None:
             raise BadRequest(
                 u"No virtual host is defined for %s" % self.context)
         path = list(path[index + 1:])
 
         if preview is True:
+            # __silva__ is the path of the Silva root, without the
+            # application: ++preview++ goes after the Silva root.
             preview_position = max(
-                len(self.context.get_root().getPhysicalPath()) - (index + 1), 0)
+                len(plugin.context.__silva__) - index, 0)
             path.insert(preview_position, '++preview++')
 
         if relative:
-            return '/' + '/'.join(rule.server_script + path)
-        return '/'.join([rule.url,] + path)
+            url = '/' + '/'.join(rule.server_script + path)
+        else:
+            url = '/'.join([rule.url,] + path)
+        plugin.urls[key] = url
+        return url
 
 
 class ContentAbsoluteURL(ContentURL, absoluteurl.ContentAbsoluteURL):
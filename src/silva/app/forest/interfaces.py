@@ -97,6 +97,19 @@ class IForestHosting(IVirtualHosting):
     """Our implements for the virtual hosting.
     """
     host = Attribute(u"Current used virtual host")
+    router = Attribute(u"Compiled virtual hosts table used to lookup hosts")
+    urls = Attribute(u"URLs computed during the request")
+
+    def query_path(host, path):
+        """Return the rule of the virtual host host matching the
+        content path, and the number of matched pieces. Results are
+        remembered for the request.
+        """
+
+    def get_urls(items, host=None, relative=False):
+        """Return the URLs of the given physical paths or catalog
+        brains, on the current virtual host, or on host.
+        """
 
 
 class IForestEvent(Interface):
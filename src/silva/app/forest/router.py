@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import threading
+
+from . import utils
+
+# Number of unknown virtual host URLs remembered by a router, and
+# for how long (in seconds). URLs are remembered by their server and
+# the part of their path that can match a host.
+UNKNOWN_HOSTS_SIZE = 2048
+UNKNOWN_HOSTS_TTL = 300
+
+# Number of virtual host URLs remembered with their host by a router.
+KNOWN_HOSTS_SIZE = 2048
+
+# Number of host names matching a wildcard host remembered by a router.
+WILDCARD_HOSTS_SIZE = 2048
+
+_lock = threading.Lock()
+_routers = {}
+
+
+class Router(object):
+    """A router is a read-only compiled version of the virtual hosts
+    table of a forest service. It is shared between all the threads of
+    the process.
+    """
+    # Any of TupleMap, RadixMap or PrefixMap can be used here. Only
+    # TupleMap builds its content from sorted items in one pass.
+    map_factory = utils.TupleMap
+
+    def __init__(self, hosts):
+        # hosts gives the compiled virtual hosts by key. The maps
+        # contain the keys, hosts are only retrieved when used.
+        self._source = hosts
+        exact = []
+        symbols = utils.SymbolTable()
+        # Wildcard hosts, by (scheme, port) and reversed labels.
+        self._wildcards = {}
+        self._bound = utils.LRUCache(WILDCARD_HOSTS_SIZE)
+        self._known = utils.LRUCache(KNOWN_HOSTS_SIZE)
+        self._unknown = utils.LRUCache(UNKNOWN_HOSTS_SIZE, UNKNOWN_HOSTS_TTL)
+        # Longest path of a host URL.
+        self._depth = 0
+        for key in hosts.iterkeys():
+            self._depth = max(self._depth, len(key) - 3)
+            labels = utils.split_wildcard(key[1])
+            if labels is None:
+                exact.append((key, key))
+                continue
+            store = self._wildcards.setdefault((key[0], key[2]), {})
+            for label in reversed(labels):
+                store = store.setdefault(symbols(label), {})
+            if None not in store:
+                store[None] = self.map_factory()
+            store[None].add(key[3:], key)
+        # Hosts by (scheme, host, port, path...).
+        self._hosts = self.map_factory.from_sorted(sorted(exact))
+        self._len = len(hosts)
+
+    def _query_wildcard(self, key):
+        store = self._wildcards.get((key[0], key[2]))
+        if store is None:
+            return None
+        # The wildcard matches at least one label.
+        labels = key[1].split('.')[1:]
+        candidates = []
+        for label in reversed(labels):
+            store = store.get(label)
+            if store is None:
+                break
+            if None in store:
+                candidates.append(store[None])
+        path = key[3:]
+        # The most specific wildcard wins.
+        for hosts in reversed(candidates):
+            found = hosts.get(path, fallback=True)[0]
+            if found is not None:
+                return found
+        return None
+
+    def query(self, key):
+        """Return the virtual host with the longest URL matching the
+        given key. Hosts declared with an exact host name win over
+        wildcard hosts.
+        """
+        found = self._hosts.get(key, fallback=True)[0]
+        if found is not None:
+            return self._source[found]
+        if self._wildcards:
+            found = self._query_wildcard(key)
+            if found is not None:
+                # Bind the wildcard host to the queried host name.
+                bound_key = (key[1], found)
+                host = self._bound.get(bound_key)
+                if host is None:
+                    host = self._bound.set(
+                        bound_key, self._source[found].bind(key[1]))
+                return host
+        return None
+
+    def _get_url_key(self, url):
+        # Only the server and the first pieces of the path can match a
+        # host, the URLs of all the pages of a host share the same key.
+        path = utils.get_url_path(url)
+        key = url[:len(url) - len(path)]
+        if self._depth:
+            for separator in '?#':
+                path = path.split(separator, 1)[0]
+            for piece in utils.path2tuple(path)[:self._depth]:
+                key += '/' + piece
+        return key
+
+    def query_url(self, url):
+        """Return the virtual host matching the given URL. URLs are
+        remembered with their host, or as unknown if they don't match
+        any virtual host, so they are not looked up again.
+        """
+        key = self._get_url_key(url)
+        host = self._known.get(key)
+        if host is not None:
+            return host
+        if self._unknown.get(key, False):
+            return None
+        host = self.query(utils.url2tuple(key))
+        if host is None:
+            self._unknown.set(key, True)
+        else:
+            self._known.set(key, host)
+        return host
+
+    def clear(self):
+        self._bound.clear()
+        self._known.clear()
+        self._unknown.clear()
+
+    def statistics(self):
+        return {'wildcard_hosts': len(self._bound),
+                'known_hosts': len(self._known),
+                'known_hosts_hits': self._known.hits,
+                'known_hosts_misses': self._known.misses,
+                'unknown_hosts': len(self._unknown),
+                'unknown_hosts_hits': self._unknown.hits,
+                'unknown_hosts_misses': self._unknown.misses}
+
+    def __len__(self):
+        return self._len
+
+
+def _get_router_key(service):
+    if service._p_jar is None or service._p_oid is None:
+        return None
+    return (service._p_jar.db().database_name, service._p_oid)
+
+
+def _get_local_router(service):
+    # Router of a service not saved or modified in the current
+    # transaction, kept on the service of this connection only.
+    router = service._v_router
+    if router is None:
+        router = service._v_router = Router(service.get_query_hosts())
+    return router
+
+
+def get_router(service):
+    """Return the router to use for the given service. The router is
+    rebuilt only when the service is modified in the database.
+    """
+    key = _get_router_key(service)
+    if key is None:
+        return _get_local_router(service)
+    # Make sure _p_serial and _p_changed are loaded.
+    service._p_activate()
+    if service._p_changed:
+        # The service is modified in the current transaction, the
+        # shared router doesn't reflect it.
+        return _get_local_router(service)
+    serial = service._p_serial
+    entry = _routers.get(key)
+    if entry is not None and entry[0] == serial:
+        return entry[1]
+    with _lock:
+        entry = _routers.get(key)
+        if entry is not None and entry[0] == serial:
+            return entry[1]
+        router = Router(service.get_query_hosts())
+        if entry is None or entry[0] < serial:
+            # Only keep the router if it is more recent than the
+            # shared one, older transactions should not evict it.
+            _routers[key] = (serial, router)
+        return router
+
+
+def invalidate_router(service):
+    """Forget the shared router of the given service.
+    """
+    service._v_router = None
+    key = _get_router_key(service)
+    if key is not None:
+        with _lock:
+            entry = _routers.pop(key, None)
+        if entry is not None:
+            entry[1].clear()
@@ -4,12 +4,16 @@
 
 import csv
 import logging
+import operator
 import urlparse
 import collections
 
+import transaction
+from persistent import Persistent
+
 from AccessControl import ClassSecurityInfo
 from App.class_init import InitializeClass
-from Acquisition import aq_inner
+from Acquisition import aq_inner, aq_base
 import zExceptions
 
 from five import grok
@@ -21,12 +25,14 @@ from zope.publisher.interfaces.browser import IBrowserSkinType
 from infrae.wsgi.utils import traverse, split_path_info
 
 from silva.app.forest import interfaces
+from silva.app.forest import skins
+from silva.app.forest import snapshot
+from silva.app.forest import timing
 from silva.app.forest import utils
+from silva.app.forest.router import get_router, invalidate_router
 from silva.core import conf as silvaconf
 from silva.core.interfaces import ISilvaObject
-from silva.core.layout.interfaces import ISkinLookup
 from silva.core.layout.traverser import SET_SKIN_ALLOWED_FLAG
-from silva.core.layout.traverser import applySkinButKeepSome
 from silva.core.services.base import SilvaService
 from silva.translations import translate as _
 from zeam.form import silva as silvaforms
@@ -55,6 +61,29 @@ def to_str(value):
 def to_url(url):
     return str(url).rstrip('/')
 
+def split_url(url):
+    """Return the server URL and the path of the given URL.
+    """
+    parts = urlparse.urlparse(url)
+    return urlparse.urlunparse(parts[:2] + ('',) * 4), parts[2]
+
+def get_snapshot_filename(service):
+    return snapshot.get_filename(
+        service._p_jar.db().database_name,
+        service._p_oid,
+        service._p_serial)
+
+def write_snapshot_file(status, service):
+    """Write the snapshot file of the service once it is committed.
+    """
+    if not status:
+        return
+    try:
+        snapshot.write_file(
+            get_snapshot_filename(service), service._snapshot.data)
+    except EnvironmentError:
+        logger.exception(u"Cannot write the virtual hosts snapshot.")
+
 
 class ForestService(SilvaService):
     grok.implements(interfaces.IForestService)
@@ -65,16 +94,21 @@ class ForestService(SilvaService):
     security = ClassSecurityInfo()
     manage_options = (
         {'label':'Settings', 'action':'manage_settings'},
+        {'label':'Timings', 'action':'manage_timings'},
         ) + SilvaService.manage_options
 
+    # Saved by an older version, the hosts are now in _hosts_data.
     _hosts = []
-    _query_hosts = {}
+    _hosts_data = None
+    _snapshot = None
+    _v_query_hosts = None
+    _v_router = None
 
     security.declareProtected(
         'View Management Screens', 'export_csv')
     def export_csv(self, stream):
         writer = csv.writer(stream)
-        for host in self._hosts:
+        for host in self.get_hosts():
             for rewrite in host.rewrites:
                 writer.writerow(map(
                         to_str, [host.url,
@@ -111,26 +145,90 @@ class ForestService(SilvaService):
     security.declareProtected(
         'View Management Screens', 'set_hosts')
     def set_hosts(self, hosts):
-        query = {}
-        root = self.getPhysicalRoot()
-        for host in hosts:
-            for entry in host.build(root):
-                if entry.key in query:
-                    raise ValueError(u"Double entry for host %s." % entry.url)
-                query[entry.key] = entry
+        query = compile_hosts(hosts, self.getPhysicalRoot())
 
         # Save changes.
-        self._hosts = hosts
-        self._query_hosts = query
+        if self._hosts_data is None:
+            self._hosts_data = HostsData(hosts)
+        else:
+            self._hosts_data.hosts = hosts
+        if '_hosts' in self.__dict__:
+            # Saved by an older version.
+            del self._hosts
+        if self._snapshot is None:
+            self._snapshot = snapshot.SnapshotData(snapshot.dump(query))
+        else:
+            self._snapshot.data = snapshot.dump(query)
+        self._v_query_hosts = query
+        if '_query_hosts' in self.__dict__:
+            # Saved by an older version.
+            del self._query_hosts
+        # The hosts are saved in their own records. Modify the service
+        # too, its serial identifies the routers and snapshot files.
+        self._p_changed = True
+        invalidate_router(self)
+        if snapshot.DIRECTORY:
+            transaction.get().addAfterCommitHook(
+                write_snapshot_file, (aq_base(self),))
+
+    def _load_snapshot(self):
+        saved = self._snapshot
+        if snapshot.DIRECTORY and self._p_jar is not None:
+            if not self._p_changed:
+                # Share the snapshot with the other processes.
+                try:
+                    return snapshot.map_file(
+                        get_snapshot_filename(self), lambda: saved.data)
+                except (EnvironmentError, snapshot.SnapshotError):
+                    logger.exception(
+                        u"Cannot map the virtual hosts snapshot.")
+        return snapshot.load(saved.data)
+
+    security.declarePrivate('get_query_hosts')
+    def get_query_hosts(self):
+        """Return the compiled virtual hosts, loaded from the
+        snapshot, or compiled again if there is no usable snapshot.
+        Invalid hosts and rewrites are then skipped.
+        """
+        query = self._v_query_hosts
+        if query is not None:
+            return query
+        if self._snapshot is not None:
+            try:
+                return SnapshotHosts(self._load_snapshot())
+            except snapshot.SnapshotError:
+                logger.warning(
+                    u"Unsupported virtual hosts snapshot, compiling them.")
+        query = compile_hosts(
+            self.get_hosts(), self.getPhysicalRoot(), strict=False)
+        self._v_query_hosts = query
+        return query
 
     security.declarePrivate('query')
     def query(self, key):
-        return self._query_hosts.get(key)
+        return get_router(self).query(key)
+
+    security.declareProtected(
+        'View Management Screens', 'get_router_statistics')
+    def get_router_statistics(self):
+        return get_router(self).statistics()
+
+    security.declareProtected(
+        'View Management Screens', 'get_timings')
+    def get_timings(self):
+        return timing.timings.get()
+
+    security.declareProtected(
+        'View Management Screens', 'clear_timings')
+    def clear_timings(self):
+        timing.timings.clear()
 
     security.declareProtected(
         'View Management Screens', 'get_hosts')
     def get_hosts(self):
-        return self._hosts
+        if self._hosts_data is None:
+            return self._hosts
+        return self._hosts_data.hosts
 
     hosts = property(get_hosts)
 
@@ -189,6 +287,15 @@ def update_hostname(url, target):
         original_parts[:2] + target_parts[2:])
 
 
+class HostsData(Persistent):
+    """Virtual hosts settings, saved in their own record so they are
+    only loaded when needed, not with the service.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+
 class Rewrite(object):
     grok.implements(interfaces.IRewrite)
 
@@ -199,90 +306,231 @@ class Rewrite(object):
         self.skin_enforce = skin_enforce
 
 
-class RewriteRule(object):
-    """A Rewrite Rule is a Rewrite used in the context of a given
-    virtual host URL.
+class RewriteTarget(object):
+    """The part of a Rewrite that doesn't depend on the virtual host
+    URL. It is shared between a virtual host and its aliases.
     """
+    _v_skin = None
+
+    def __init__(self, original, path, skin=None, skin_enforce=True):
+        self.original = original
+        self.path = path
+        self.skin = skin
+        self.skin_enforce = skin_enforce
 
-    def __init__(self, root, url, rewrite):
-        self.path = utils.path2tuple(rewrite.rewrite)
-        self.url = to_url(url + rewrite.original)
-        parts = urlparse.urlparse(self.url)
-        self.server_url = urlparse.urlunparse(parts[:2] + ('',) * 4)
-        self.server_script = split_path_info(parts[2])
-        self.skin = rewrite.skin
-        self.skin_enforce = rewrite.skin_enforce
+    @classmethod
+    def from_rewrite(cls, root, rewrite, symbols):
+        """Create the target of a Rewrite, verifying its path.
+        """
+        path = symbols.tuple(utils.path2tuple(rewrite.rewrite))
         try:
-            traverse(self.path, root)
+            traverse(path, root)
         except zExceptions.BadRequest:
             raise ValueError(u"Invalid rewrite path %s" % rewrite.rewrite)
+        return cls(
+            symbols(rewrite.original), path,
+            rewrite.skin, rewrite.skin_enforce)
+
+    def get_skin(self):
+        """Return the skin set for this target, or None if there is
+        none or it is missing.
+        """
+        if not self.skin:
+            return None
+        generation = skins.get_generation()
+        cached = self._v_skin
+        if cached is None or cached[0] != generation:
+            cached = self._v_skin = (
+                generation, queryUtility(IBrowserSkinType, name=self.skin))
+        return cached[1]
+
+
+class RewriteRule(object):
+    """A Rewrite Rule is a Rewrite used in the context of a given
+    virtual host URL.
+    """
 
-    def apply(self, root, request):
+    def __init__(self, target, url, server=None, symbols=None):
+        if symbols is None:
+            symbols = utils.SymbolTable()
+        if server is None:
+            server = split_url(url)
+        self.target = target
+        self.url = symbols(to_url(url + target.original))
+        # server is the server URL and path of url.
+        self.server_url = symbols(server[0])
+        self.server_script = map(
+            symbols, split_path_info(server[1] + target.original))
+        # URL of the request, as _resetURLS computes it.
+        self.request_url = symbols(
+            '/'.join([self.server_url] + self.server_script))
+
+    path = property(lambda self: self.target.path)
+    skin = property(lambda self: self.target.skin)
+    skin_enforce = property(lambda self: self.target.skin_enforce)
+
+    def get_skin(self):
+        return self.target.get_skin()
+
+    def rewrite_request(self, request):
+        """Update the URLs of the request for this rule.
+        """
+        other = request.other
+        other['SERVER_URL'] = self.server_url
+        other['ACTUAL_URL'] = self.server_url + utils.get_url_path(
+            other['ACTUAL_URL'])
+        # The script is modified by the request, it cannot be shared.
+        request._script = list(self.server_script)
+        if request._steps or request._urls:
+            request._resetURLS()
+        else:
+            # No URL derived from the script have been computed yet.
+            other['URL'] = self.request_url
+
+    def apply(self, root, request, timer=timing.NULL_TIMER):
+        target = self.target
         try:
-            content = traverse(self.path, root, request)
+            content = traverse(target.path, root, request)
         except zExceptions.BadRequest:
+            skins.mark_request(request)
             return root
-        request['URL'] = self.url
-        request['ACTUAL_URL'] = self.server_url + urlparse.urlunparse(
-            ('', '') + urlparse.urlparse(request['ACTUAL_URL'])[2:])
-        request['SERVER_URL'] = str(self.server_url)
-        request._script = list(self.server_script)
-        request._resetURLS()
-        if self.skin:
-            # Apply hardcoded skin
-            skin = queryUtility(IBrowserSkinType, name=self.skin)
-            if skin is None:
-                logger.error(
-                    u"Missing skin '%s', please update your settings.",
-                    self.skin)
-            else:
-                applySkinButKeepSome(request, skin)
-                if self.skin_enforce:
-                    request[SET_SKIN_ALLOWED_FLAG] = False
-        else:
+        timer.mark('traverse')
+        self.rewrite_request(request)
+        timer.mark('rewrite')
+        skin = None
+        if target.skin:
+            # Apply hardcoded skin. A missing skin is reported by
+            # set_hosts.
+            skin = target.get_skin()
+            if skin is not None and target.skin_enforce:
+                request[SET_SKIN_ALLOWED_FLAG] = False
+        elif ISilvaObject.providedBy(content):
             # Fallback on the default Silva skin
-            if ISilvaObject.providedBy(content):
-                publication = content.get_publication()
-                skin_lookup = ISkinLookup(publication, None)
-                if skin_lookup is not None:
-                    skin = skin_lookup.get_skin(request)
-                    if skin is not None:
-                        # We found a skin to apply
-                        applySkinButKeepSome(request, skin)
+            skin = skins.get_publication_skin(
+                content.get_publication(), request)
+        skins.mark_request(request, skin)
+        timer.mark('skin')
         return content
 
 
+class RewriteSet(object):
+    """The rewrites of a virtual host, compiled once and shared
+    between the host and its aliases. The maps contain the index of
+    the targets.
+    """
+    # Any of TupleMap, RadixMap or PrefixMap can be used here. Only
+    # TupleMap builds its content from sorted items in one pass.
+    map_factory = utils.TupleMap
+
+    def __init__(self, url, targets, symbols=None):
+        if symbols is None:
+            symbols = utils.SymbolTable()
+        self.targets = tuple(targets)
+        by_original = []
+        by_path = []
+        for index, target in enumerate(self.targets):
+            by_original.append(
+                (symbols.tuple(utils.path2tuple(target.original)), index))
+            by_path.append((target.path, index))
+
+        # Build the maps in one pass, and report all the duplicates.
+        errors = []
+        try:
+            self.by_original = self.map_factory.from_sorted(
+                sorted(by_original, key=operator.itemgetter(0)))
+        except utils.DuplicateKeysError as error:
+            errors.extend(
+                u"Duplicate url entry for /%s in %s" % ('/'.join(key), url)
+                for key in error.keys)
+        try:
+            self.by_path = self.map_factory.from_sorted(
+                sorted(by_path, key=operator.itemgetter(0)))
+        except utils.DuplicateKeysError as error:
+            errors.extend(
+                u"Duplicate path entry for /%s in %s" % ('/'.join(key), url)
+                for key in error.keys)
+        if errors:
+            raise ValueError(u"\n".join(errors))
+        # by_original is not modified after this point.
+        self.top_levels = tuple(self.by_original.top())
+        # Paths having a target below them.
+        self.branches = frozenset(
+            symbols.tuple(path[:length])
+            for path, index in by_path
+            for length in range(len(path)))
+
+
 class VirtualHostRule(object):
     """A virtual host lookup entry is the result of returned by a
     query to the service.
     """
 
-    def __init__(self, root, url, rewrites):
+    def __init__(self, url, rewrites, symbols=None):
+        if symbols is None:
+            symbols = utils.SymbolTable()
         self.url = url
-        self.key = utils.url2tuple(url)
-        self.by_url = utils.TupleMap()
-        self.by_path = utils.TupleMap()
-
-        base = self.key[3:]
-        for rewrite in rewrites:
-            rule = RewriteRule(root, url, rewrite)
-            try:
-                self.by_url.add(
-                    base + utils.path2tuple(rewrite.original),
-                    rule)
-            except KeyError:
-                raise ValueError(
-                    u"Duplicate url entry for %s in %s" % (
-                        rewrite.original, url))
-            try:
-                self.by_path.add(rule.path, rule)
-            except KeyError:
-                raise ValueError(
-                    u"Duplicate path entry for %s in %s" % (
-                        rewrite.rewrite, url))
+        # URL of the declared host, different from url if the host
+        # is a wildcard host bound to a host name.
+        self.declared_url = url
+        self.key = symbols.tuple(utils.url2tuple(url))
+        self.base = symbols.tuple(self.key[3:])
+        self.rewrites = rewrites
+        server = split_url(url)
+        self.rules = tuple(RewriteRule(target, url, server, symbols)
+                           for target in rewrites.targets)
+        self.top_levels = tuple(self.rules[index]
+                                for index in rewrites.top_levels)
+
+    def bind(self, hostname):
+        """Return this host for the given host name, matching its
+        wildcard.
+        """
+        parts = urlparse.urlsplit(self.url)
+        netloc = hostname + ''.join(parts[1].partition(':')[1:])
+        host = self.__class__(
+            urlparse.urlunsplit(parts[:1] + (netloc,) + parts[2:]),
+            self.rewrites)
+        host.declared_url = self.declared_url
+        return host
+
+    def get_top_levels(self):
+        """Return the rules with the shortest URL in this host.
+        """
+        return self.top_levels
 
     def query(self, key):
-        return self.by_url.get(key, fallback=True)
+        """Return the rule matching the longest prefix of the given
+        URL path, and the number of matched pieces.
+        """
+        size = len(self.base)
+        if key[:size] != self.base:
+            return None, 0
+        index, matched = self.rewrites.by_original.get(
+            key[size:], fallback=True)
+        if index is None:
+            return None, 0
+        if size == len(key):
+            # The maps count one piece for an empty key.
+            matched = size or 1
+        else:
+            matched += size
+        return self.rules[index], matched
+
+    def query_path(self, path):
+        """Return the rule matching the longest prefix of the given
+        content path, and the number of matched pieces.
+        """
+        index, matched = self.rewrites.by_path.get(path, fallback=True)
+        if index is None:
+            return None, matched
+        return self.rules[index], matched
+
+    def has_targets_below(self, path):
+        """Return True if a rule targets a content below path. If
+        not, query_path returns the same result for path and all the
+        paths below it.
+        """
+        return path in self.rewrites.branches
 
 
 class VirtualHost(object):
@@ -293,9 +541,103 @@ class VirtualHost(object):
         self.aliases = map(to_url, aliases)
         self.rewrites = rewrites
 
-    def build(self, root):
+    def build(self, root, symbols=None, strict=True):
+        """Compile the host and its aliases. If strict is false,
+        invalid rewrites are logged and skipped.
+        """
+        if symbols is None:
+            symbols = utils.SymbolTable()
+        # The rewrites are compiled and validated once for all the URLs.
+        targets = []
+        for rewrite in self.rewrites:
+            try:
+                targets.append(
+                    RewriteTarget.from_rewrite(root, rewrite, symbols))
+            except ValueError as error:
+                if strict:
+                    raise
+                logger.error(u"Skipping rewrite in %s: %s", self.url, error)
+        rewrites = RewriteSet(self.url, targets, symbols)
         for url in [self.url] + self.aliases:
-            yield VirtualHostRule(root, url, self.rewrites)
+            yield VirtualHostRule(url, rewrites, symbols)
+
+
+def compile_hosts(hosts, root, strict=True):
+    """Compile the given virtual hosts, and return them by key. If
+    strict is false, invalid hosts and rewrites are logged and skipped
+    instead of raising ValueError.
+    """
+    query = {}
+    missing_skins = set()
+    # Strings and paths are shared by all the compiled hosts.
+    symbols = utils.SymbolTable()
+    for host in hosts:
+        try:
+            entries = list(host.build(root, symbols, strict))
+        except ValueError as error:
+            if strict:
+                raise
+            logger.error(u"Skipping host %s: %s", host.url, error)
+            continue
+        for entry in entries:
+            error = None
+            if entry.key in query:
+                error = u"Double entry for host %s." % entry.url
+            elif ('*' in entry.key[1] and
+                  utils.split_wildcard(entry.key[1]) is None):
+                error = u"Invalid wildcard host %s." % entry.url
+            if error is not None:
+                if strict:
+                    raise ValueError(error)
+                logger.error(u"Skipping host: %s", error)
+                continue
+            query[entry.key] = entry
+            for rule in entry.rules:
+                if rule.skin and rule.get_skin() is None:
+                    missing_skins.add(rule.skin)
+    for name in sorted(missing_skins):
+        logger.error(
+            u"Missing skin '%s', please update your settings.", name)
+    return query
+
+
+class SnapshotHosts(object):
+    """Compiled virtual hosts loaded from a snapshot. A host, and its
+    rewrites, are only created when it is used.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._keys = dict(snapshot.keys())
+        self._symbols = utils.SymbolTable()
+        # Created hosts and rewrites. Threads can concurrently create
+        # the same host, only one of them is kept.
+        self._hosts = {}
+        self._rewrites = {}
+
+    def _get_rewrites(self, number, url):
+        rewrites = self._rewrites.get(number)
+        if rewrites is None:
+            rewrites = self._rewrites.setdefault(number, RewriteSet(
+                    url,
+                    [RewriteTarget(*target)
+                     for target in self._snapshot.targets(number)],
+                    self._symbols))
+        return rewrites
+
+    def __getitem__(self, key):
+        host = self._hosts.get(key)
+        if host is None:
+            url, number = self._snapshot.host(self._keys[key])
+            host = self._hosts.setdefault(key, VirtualHostRule(
+                    url, self._get_rewrites(number, url), self._symbols))
+        return host
+
+    def iterkeys(self):
+        return self._keys.iterkeys()
+
+    def __len__(self):
+        return len(self._keys)
 
 
 grok.global_utility(
@@ -412,6 +754,18 @@ class ForestVirtualHostExportSettings(silvaforms.ZMISubForm):
         self.redirect(self.url('export.csv'))
 
 
+class ForestTimings(grok.View):
+    grok.context(ForestService)
+    grok.require('zope2.ViewManagementScreens')
+    grok.name('manage_timings')
+
+    def update(self, clear=False):
+        self.enabled = timing.ENABLED
+        if clear and self.request.method == 'POST':
+            self.context.clear_timings()
+        self.timings = self.context.get_timings()
+
+
 class ForestVirtualHostExport(grok.View):
     grok.context(ForestService)
     grok.require('zope2.ViewManagementScreens')
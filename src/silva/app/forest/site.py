@@ -14,7 +14,7 @@ class ForestVirtualSite(WSGIVirtualSite):
     def get_top_level_url(self):
         plugin = self.request.get_plugin(IVirtualHosting)
         if IForestHosting.providedBy(plugin) and plugin.host is not None:
-            top_levels = plugin.host.by_url.top()
+            top_levels = plugin.host.get_top_levels()
             if len(top_levels) == 1:
                 return top_levels[0].server_url
         return super(ForestVirtualSite, self).get_top_level_url()
@@ -22,7 +22,7 @@ class ForestVirtualSite(WSGIVirtualSite):
     def get_top_level_path(self):
         plugin = self.request.get_plugin(IVirtualHosting)
         if IForestHosting.providedBy(plugin) and plugin.host is not None:
-            top_levels = plugin.host.by_url.top()
+            top_levels = plugin.host.get_top_levels()
             if len(top_levels) == 1:
                 return '/' + '/'.join(top_levels[0].server_script)
         return super(ForestVirtualSite, self).get_top_level_path()
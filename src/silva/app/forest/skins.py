@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+
+from Acquisition import aq_parent
+from five import grok
+from zope.component.interfaces import IRegistrationEvent
+from zope.component.interfaces import IUtilityRegistration
+from zope.event import notify
+from zope.interface import directlyProvidedBy, directlyProvides
+from zope.publisher.browser import SkinChangedEvent
+from zope.publisher.interfaces.browser import IBrowserSkinType
+
+from silva.core.interfaces import IPublication, IRoot
+from silva.core.layout.interfaces import ICustomizableLayer, ISkinLookup
+
+from . import utils
+from .interfaces import IForestRequest
+
+# Number of publications for which the skin is remembered.
+PUBLICATION_SKINS_SIZE = 4096
+
+# Number of combinations of interfaces and skin remembered.
+REQUEST_PROVIDES_SIZE = 256
+
+# Incremented each time a skin is registered or unregistered, cached
+# skins computed with an older generation must be looked up again.
+_generation = 0
+_publications = utils.LRUCache(PUBLICATION_SKINS_SIZE)
+# Interfaces to provide on a request, by previously provided
+# interfaces and skin.
+_provides = utils.LRUCache(REQUEST_PROVIDES_SIZE)
+
+
+def get_generation():
+    return _generation
+
+
+@grok.subscribe(IUtilityRegistration, IRegistrationEvent)
+def update_generation(registration, event):
+    global _generation
+    if registration.provided.isOrExtends(IBrowserSkinType):
+        _generation += 1
+
+
+def get_serials(publication):
+    """Return the serials of the publication and the publications
+    above it, from which the skin setting can be acquired. None is
+    returned if one of them is modified in the current transaction.
+    """
+    serials = []
+    content = publication
+    while content is not None:
+        if IPublication.providedBy(content):
+            if content._p_changed or content._p_oid is None:
+                return None
+            serials.append(content._p_serial)
+        if IRoot.providedBy(content):
+            break
+        content = aq_parent(content)
+    return tuple(serials)
+
+
+def get_publication_skin(publication, request):
+    """Return the skin to use for the given publication, or None. The
+    skin is remembered per process until the publication, one of the
+    publications above it, or the registered skins change.
+    """
+    key = None
+    if publication._p_jar is not None and publication._p_oid is not None:
+        key = (publication._p_jar.db().database_name, publication._p_oid)
+        entry = _publications.get(key)
+        if (entry is not None and
+            entry[0] == _generation and
+            entry[1] == get_serials(publication)):
+            return entry[2]
+    skin = None
+    skin_lookup = ISkinLookup(publication, None)
+    if skin_lookup is not None:
+        skin = skin_lookup.get_skin(request)
+    if key is not None:
+        serials = get_serials(publication)
+        if serials is not None:
+            _publications.set(key, (_generation, serials, skin))
+    return skin
+
+
+def mark_request(request, skin=None):
+    """Mark the request as a forest request and apply the skin on it,
+    if any, like applySkinButKeepSome would do. The interfaces are
+    set in one step and computed once for a given combination.
+    """
+    # Declarations are compared by identity, use their interfaces.
+    provided = tuple(directlyProvidedBy(request))
+    key = (provided, skin)
+    interfaces = _provides.get(key)
+    if interfaces is None:
+        interfaces = []
+        for iface in provided:
+            if skin is not None and iface.extends(ICustomizableLayer):
+                continue
+            interfaces.append(iface)
+        for iface in (skin, IForestRequest):
+            if iface is not None and iface not in interfaces:
+                interfaces.append(iface)
+        interfaces = _provides.set(key, tuple(interfaces))
+    directlyProvides(request, *interfaces)
+    if skin is not None:
+        notify(SkinChangedEvent(request))
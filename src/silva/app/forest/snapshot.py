@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Compact serialized format of the compiled virtual hosts.
+
+A snapshot is a header followed by flat arrays of little-endian
+signed 32 bits integers, and the strings::
+
+  header   MAGIC, VERSION and the size of each array
+  hosts    (key, url, set) for each host
+  sets     (start, end) range of the targets of each rewrite set
+  targets  (original, path, skin, skin_enforce) for each target
+  strings  offsets of the strings in the data
+  paths    offsets of the paths in the items
+  items    the strings of each path
+  data     all the strings, encoded in UTF-8
+
+Strings are referred by their index, and tuples of strings (host keys
+and target paths) by their index in paths. -1 is None.
+
+A snapshot is read in place, it can be a string or a memory mapped
+file shared between processes.
+"""
+
+import binascii
+import mmap
+import os
+import struct
+import tempfile
+
+from persistent import Persistent
+
+MAGIC = 'SFOREST\x00'
+VERSION = 3
+
+HEADER = struct.Struct('<8s7i')
+HOST = struct.Struct('<3i')
+SET = struct.Struct('<2i')
+TARGET = struct.Struct('<4i')
+RANGE = struct.Struct('<2i')
+INTEGER_SIZE = 4
+
+# Snapshots are shared between processes in memory mapped files in
+# this directory, if SILVA_FOREST_SNAPSHOTS is set in the environment.
+DIRECTORY = os.environ.get('SILVA_FOREST_SNAPSHOTS') or None
+
+
+class SnapshotError(ValueError):
+    """The snapshot is invalid or in an unsupported version.
+    """
+
+
+class SnapshotData(Persistent):
+    """Snapshot saved in the database, in its own record so it is
+    only loaded when needed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _pack(fmt, values):
+    return struct.pack('<%d%s' % (len(values), fmt), *values)
+
+
+def dump(hosts):
+    """Return the snapshot of the given compiled hosts.
+    """
+    strings = []
+    string_indexes = {}
+    paths = []
+    path_indexes = {}
+
+    def string(value):
+        if value is None:
+            return -1
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        index = string_indexes.get(value)
+        if index is None:
+            index = string_indexes[value] = len(strings)
+            strings.append(value)
+        return index
+
+    def path(values):
+        if values is None:
+            return -1
+        values = tuple(string(value) for value in values)
+        index = path_indexes.get(values)
+        if index is None:
+            index = path_indexes[values] = len(paths)
+            paths.append(values)
+        return index
+
+    host_records = []
+    set_records = []
+    set_indexes = {}
+    target_records = []
+    for key, host in sorted(hosts.iteritems()):
+        rewrites = host.rewrites
+        number = set_indexes.get(id(rewrites))
+        if number is None:
+            # Sets are shared between a host and its aliases.
+            number = set_indexes[id(rewrites)] = len(set_records)
+            start = len(target_records)
+            for target in rewrites.targets:
+                target_records.append((
+                        string(target.original),
+                        path(target.path),
+                        string(target.skin),
+                        int(bool(target.skin_enforce))))
+            set_records.append((start, len(target_records)))
+        host_records.append((path(key), string(host.url), number))
+
+    string_offsets = [0]
+    for value in strings:
+        string_offsets.append(string_offsets[-1] + len(value))
+    path_offsets = [0]
+    items = []
+    for values in paths:
+        items.extend(values)
+        path_offsets.append(len(items))
+    return ''.join([
+            HEADER.pack(
+                MAGIC, VERSION,
+                len(host_records), len(set_records), len(target_records),
+                len(strings), len(paths), len(items)),
+            ''.join(HOST.pack(*record) for record in host_records),
+            ''.join(SET.pack(*record) for record in set_records),
+            ''.join(TARGET.pack(*record) for record in target_records),
+            _pack('i', string_offsets),
+            _pack('i', path_offsets),
+            _pack('i', items)] + strings)
+
+
+class Snapshot(object):
+    """Read access to a snapshot, without loading it.
+    """
+
+    def __init__(self, data):
+        if len(data) < HEADER.size:
+            raise SnapshotError(u"Invalid snapshot.")
+        header = HEADER.unpack_from(data)
+        if header[:2] != (MAGIC, VERSION):
+            raise SnapshotError(u"Unsupported snapshot version.")
+        hosts, sets, targets, strings, paths, items = header[2:]
+        self._data = data
+        self._size = hosts
+        self._hosts = HEADER.size
+        self._sets = self._hosts + HOST.size * hosts
+        self._targets = self._sets + SET.size * sets
+        self._strings = self._targets + TARGET.size * targets
+        self._paths = self._strings + INTEGER_SIZE * (strings + 1)
+        self._items = self._paths + INTEGER_SIZE * (paths + 1)
+        self._text = self._items + INTEGER_SIZE * items
+        if (len(data) < self._text or
+            len(data) != self._text + self._integer(
+                self._strings + INTEGER_SIZE * strings)):
+            raise SnapshotError(u"Invalid snapshot.")
+
+    def _integer(self, offset):
+        return struct.unpack_from('<i', self._data, offset)[0]
+
+    def _string(self, index):
+        if index < 0:
+            return None
+        start, end = RANGE.unpack_from(
+            self._data, self._strings + INTEGER_SIZE * index)
+        return self._data[self._text + start:self._text + end]
+
+    def _path(self, index):
+        if index < 0:
+            return None
+        start, end = RANGE.unpack_from(
+            self._data, self._paths + INTEGER_SIZE * index)
+        return tuple(map(self._string, struct.unpack_from(
+                    '<%di' % (end - start),
+                    self._data, self._items + INTEGER_SIZE * start)))
+
+    def keys(self):
+        """Return the (key, number) of all the hosts.
+        """
+        return [(self._path(HOST.unpack_from(
+                        self._data, self._hosts + HOST.size * number)[0]),
+                 number)
+                for number in range(self._size)]
+
+    def host(self, number):
+        """Return the URL and the rewrites number of a host.
+        """
+        key, url, rewrites = HOST.unpack_from(
+            self._data, self._hosts + HOST.size * number)
+        return self._string(url), rewrites
+
+    def targets(self, number):
+        """Return the (original, path, skin, skin_enforce) of the
+        targets of the given rewrites.
+        """
+        start, end = SET.unpack_from(
+            self._data, self._sets + SET.size * number)
+        result = []
+        for index in range(start, end):
+            original, path, skin, skin_enforce = TARGET.unpack_from(
+                self._data, self._targets + TARGET.size * index)
+            result.append((
+                    self._string(original),
+                    self._path(path),
+                    self._string(skin),
+                    bool(skin_enforce)))
+        return result
+
+    def __len__(self):
+        return self._size
+
+
+def load(data):
+    """Read a snapshot created by dump. SnapshotError is raised if
+    it is invalid or in an other version.
+    """
+    try:
+        return Snapshot(data)
+    except struct.error:
+        raise SnapshotError(u"Invalid snapshot.")
+
+
+def get_filename(database, oid, serial):
+    """Return the name of the snapshot file of a service.
+    """
+    return '%s-%s-%s.snapshot' % (
+        database, binascii.hexlify(oid), binascii.hexlify(serial))
+
+
+def write_file(filename, data):
+    """Write a snapshot file and remove the ones of older serials of
+    the same service. The file is replaced atomically.
+    """
+    descriptor, temporary = tempfile.mkstemp(
+        prefix='.' + filename, dir=DIRECTORY)
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            stream.write(data)
+        os.rename(temporary, os.path.join(DIRECTORY, filename))
+    except:
+        os.unlink(temporary)
+        raise
+    prefix = filename.rsplit('-', 1)[0] + '-'
+    for other in os.listdir(DIRECTORY):
+        if (other.startswith(prefix) and other.endswith('.snapshot') and
+            other < filename):
+            try:
+                # Processes using it keep their mapping.
+                os.unlink(os.path.join(DIRECTORY, other))
+            except OSError:
+                pass
+
+
+def map_file(filename, get_data):
+    """Return the snapshot of the given file, memory mapped. If the
+    file doesn't exist or is invalid, it is written with get_data().
+    """
+    path = os.path.join(DIRECTORY, filename)
+    for attempt in range(2):
+        try:
+            with open(path, 'rb') as stream:
+                data = mmap.mmap(
+                    stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            # Missing or empty file.
+            data = None
+        if data is not None:
+            try:
+                return load(data)
+            except SnapshotError:
+                data.close()
+        if attempt:
+            break
+        write_file(filename, get_data())
+    raise SnapshotError(u"Cannot map the snapshot %s." % filename)
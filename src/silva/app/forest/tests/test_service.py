@@ -5,6 +5,9 @@
 import io
 import unittest
 
+import transaction
+from persistent import GHOST
+
 from zope.component import queryUtility
 from zope.interface.verify import verifyObject
 from infrae.wsgi.testing import TestRequest
@@ -14,7 +17,8 @@ from Products.Silva.testing import assertTriggersEvents, assertNotTriggersEvents
 
 from ..interfaces import IForestService, IVirtualHost, IRewrite
 from ..interfaces import IForestHosting
-from ..service import VirtualHost, Rewrite
+from ..service import VirtualHost, Rewrite, RewriteRule, RewriteTarget
+from ..router import get_router
 from ..testing import FunctionalLayer
 from ..utils import url2tuple
 
@@ -34,6 +38,27 @@ class ServiceTestCase(unittest.TestCase):
         service.set_hosts([])
         self.assertEqual(service.get_hosts(), [])
 
+    def test_hosts_record(self):
+        """The hosts are saved in their own record, not loaded with
+        the service.
+        """
+        service = queryUtility(IForestService)
+        hosts = [
+            VirtualHost(
+                'http://infrae.com',
+                [],
+                [Rewrite('/', '/root', None)])]
+        service.set_hosts(hosts)
+        transaction.commit()
+        self.assertNotIn('_hosts', service.__dict__)
+        self.assertIsNot(service._hosts_data._p_oid, None)
+        service._hosts_data._p_deactivate()
+        self.assertEqual(service._hosts_data._p_state, GHOST)
+        self.assertIsNot(
+            service.query(url2tuple('http://infrae.com')), None)
+        self.assertEqual(service._hosts_data._p_state, GHOST)
+        self.assertEqual(len(service.get_hosts()), 1)
+
     def test_activation(self):
         service = queryUtility(IForestService)
         with assertTriggersEvents(
@@ -60,6 +85,24 @@ class ServiceTestCase(unittest.TestCase):
             with assertNotTriggersEvents():
                 service.deactivate()
 
+    def test_activation_service_location(self):
+        """The virtual hosting plugin finds the service of the
+        activated Silva root.
+        """
+        service = queryUtility(IForestService)
+        service.activate()
+        transaction.commit()
+
+        for attempt in range(2):
+            request = TestRequest(application=self.root)
+            plugin = request.query_plugin(
+                request.application, IVirtualHosting)
+            self.assertTrue(verifyObject(IForestHosting, plugin))
+            self.assertTrue(IForestService.providedBy(plugin.service))
+            self.assertEqual(
+                plugin.service.getPhysicalPath(),
+                service.getPhysicalPath())
+
     def test_host_root(self):
         """Set an host that is the root of the URL.
         """
@@ -199,6 +242,11 @@ class ServiceTestCase(unittest.TestCase):
         self.assertEqual(query_rule.server_url, 'http://infrae.com')
         self.assertEqual(query_rule.server_script, ['admin'])
 
+        top_levels = query_host.get_top_levels()
+        self.assertEqual(len(top_levels), 1)
+        self.assertEqual(top_levels[0].url, 'http://infrae.com')
+        self.assertIs(query_host.get_top_levels(), top_levels)
+
         query_rule, index = query_host.query(('hidden', 'advanced',))
         self.assertIsNot(query_rule, None)
         self.assertEqual(index, 2)
@@ -207,6 +255,17 @@ class ServiceTestCase(unittest.TestCase):
         self.assertEqual(query_rule.server_url, 'http://infrae.com')
         self.assertEqual(query_rule.server_script, ['hidden', 'advanced'])
 
+    def test_rule_request_url(self):
+        """The request URL of a rule is built from its normalized
+        script, like the request would do.
+        """
+        rule = RewriteRule(
+            RewriteTarget('/docs//./admin', ('root', 'docs')),
+            'http://infrae.com/site')
+        self.assertEqual(rule.url, 'http://infrae.com/site/docs//./admin')
+        self.assertEqual(rule.server_script, ['site', 'docs', 'admin'])
+        self.assertEqual(rule.request_url, 'http://infrae.com/site/docs/admin')
+
     def test_host_duplicate(self):
         """Try to create a duplicated host.
         """
@@ -269,6 +328,305 @@ class ServiceTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             service.set_hosts(hosts)
 
+    def test_host_duplicate_all(self):
+        """All the duplicated entries of a host are reported together.
+        """
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addFolder('manual', 'Manual')
+
+        service = queryUtility(IForestService)
+        hosts = [
+            VirtualHost(
+                'http://infrae.com',
+                [],
+                [Rewrite('/', '/root', None),
+                 Rewrite('/docs', '/root', None),
+                 Rewrite('/manual', '/root/manual', None),
+                 Rewrite('/manual', '/root/manual', None)])]
+
+        with self.assertRaises(ValueError) as error:
+            service.set_hosts(hosts)
+        message = unicode(error.exception)
+        self.assertIn(
+            u"Duplicate url entry for /manual in http://infrae.com",
+            message)
+        self.assertIn(
+            u"Duplicate path entry for /root in http://infrae.com",
+            message)
+        self.assertIn(
+            u"Duplicate path entry for /root/manual in http://infrae.com",
+            message)
+
+    def test_host_aliases(self):
+        """The rewrites of a host are compiled once and shared with
+        its aliases.
+        """
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addFolder('docs', 'Docs')
+
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    ['http://www.infrae.com/site'],
+                    [Rewrite('/', '/root', None),
+                     Rewrite('/docs', '/root/docs', None)])])
+
+        query_host = service.query(url2tuple('http://infrae.com'))
+        alias_host = service.query(url2tuple('http://www.infrae.com/site'))
+        self.assertIsNot(query_host, None)
+        self.assertIsNot(alias_host, None)
+        self.assertIs(query_host.rewrites, alias_host.rewrites)
+
+        query_rule, index = query_host.query(('docs', 'index'))
+        alias_rule, alias_index = alias_host.query(('site', 'docs', 'index'))
+        self.assertEqual(index, 1)
+        self.assertEqual(alias_index, 2)
+        self.assertIs(query_rule.target, alias_rule.target)
+        self.assertIs(query_rule.server_script[0], alias_rule.server_script[1])
+        self.assertEqual(query_rule.url, 'http://infrae.com/docs')
+        self.assertEqual(alias_rule.url, 'http://www.infrae.com/site/docs')
+        self.assertEqual(alias_rule.server_url, 'http://www.infrae.com')
+        self.assertEqual(alias_rule.server_script, ['site', 'docs'])
+        self.assertEqual(alias_host.query(('docs', 'index')), (None, 0))
+
+        alias_rule, index = alias_host.query_path(('root', 'docs', 'index'))
+        self.assertEqual(index, 2)
+        self.assertEqual(alias_rule.url, 'http://www.infrae.com/site/docs')
+
+    def test_router(self):
+        """The router is shared as long as the service is not modified.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        # The service is modified, the router is not shared but kept
+        # on the service until its hosts change.
+        router = get_router(service)
+        self.assertIs(get_router(service), router)
+        self.assertIsNot(router.query(url2tuple('http://infrae.com')), None)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        self.assertIsNot(get_router(service), router)
+        transaction.commit()
+
+        router = get_router(service)
+        self.assertIs(get_router(service), router)
+        self.assertEqual(len(router), 1)
+        self.assertIsNot(router.query(url2tuple('http://infrae.com')), None)
+        self.assertIs(router.query(url2tuple('http://silvacms.org')), None)
+
+        # Changing the hosts rebuild the router.
+        service.set_hosts([])
+        transaction.commit()
+        self.assertIsNot(get_router(service), router)
+        self.assertIs(
+            get_router(service).query(url2tuple('http://infrae.com')), None)
+
+    def test_router_other_connection(self):
+        """Other connections, like other processes, see the new hosts
+        once they are committed.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+        serial = service._p_serial
+
+        connection = service._p_jar.db().open()
+        try:
+            other = connection.get(service._p_oid)
+            router = get_router(other)
+            self.assertEqual(other._p_serial, serial)
+            self.assertIsNot(
+                router.query(url2tuple('http://infrae.com')), None)
+
+            service.set_hosts([
+                    VirtualHost(
+                        'http://silvacms.org',
+                        [],
+                        [Rewrite('/', '/root', None)])])
+            transaction.commit()
+            connection.sync()
+            # The service serial changed, the routers built for the
+            # previous one are not used anymore.
+            self.assertNotEqual(other._p_serial, serial)
+            self.assertIsNot(get_router(other), router)
+            self.assertIs(
+                get_router(other).query(url2tuple('http://infrae.com')),
+                None)
+            self.assertIsNot(
+                get_router(other).query(url2tuple('http://silvacms.org')),
+                None)
+        finally:
+            connection.close()
+
+        # Aborted hosts are not used.
+        service.set_hosts([])
+        transaction.abort()
+        self.assertIsNot(
+            get_router(service).query(url2tuple('http://silvacms.org')),
+            None)
+
+    def test_router_wildcard(self):
+        """Wildcard hosts match any sub-domain, exact hosts and more
+        specific wildcards win.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://*.infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)]),
+                VirtualHost(
+                    'http://*.customers.infrae.com:8080',
+                    [],
+                    [Rewrite('/', '/root', None)]),
+                VirtualHost(
+                    'http://www.infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+
+        router = get_router(service)
+        self.assertEqual(len(router), 3)
+        host = router.query(url2tuple('http://www.infrae.com'))
+        self.assertEqual(host.url, 'http://www.infrae.com')
+        host = router.query(url2tuple('http://docs.infrae.com'))
+        self.assertEqual(host.url, 'http://docs.infrae.com')
+        self.assertEqual(host.declared_url, 'http://*.infrae.com')
+        self.assertIs(router.query(url2tuple('http://docs.infrae.com')), host)
+        host = router.query(url2tuple('http://acme.customers.infrae.com'))
+        self.assertEqual(host.url, 'http://acme.customers.infrae.com')
+        host = router.query(
+            url2tuple('http://acme.customers.infrae.com:8080'))
+        self.assertEqual(host.url, 'http://acme.customers.infrae.com:8080')
+        rule, index = host.query(('index',))
+        self.assertEqual(rule.url, 'http://acme.customers.infrae.com:8080')
+        self.assertEqual(
+            rule.server_url, 'http://acme.customers.infrae.com:8080')
+        self.assertIs(router.query(url2tuple('http://infrae.com')), None)
+        self.assertIs(router.query(url2tuple('https://www.infrae.com')), None)
+
+    def test_router_prefix(self):
+        """The host with the longest URL matching the queried URL is
+        used.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)]),
+                VirtualHost(
+                    'http://infrae.com/docs',
+                    [],
+                    [Rewrite('/', '/root', None)]),
+                VirtualHost(
+                    'http://*.infrae.com/docs',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+
+        router = get_router(service)
+        host = router.query(url2tuple('http://infrae.com/docs/silva/index'))
+        self.assertEqual(host.url, 'http://infrae.com/docs')
+        host = router.query(url2tuple('http://infrae.com/documents'))
+        self.assertEqual(host.url, 'http://infrae.com')
+        host = router.query(url2tuple('http://www.infrae.com/docs/silva'))
+        self.assertEqual(host.url, 'http://www.infrae.com/docs')
+        self.assertIs(router.query(url2tuple('http://www.infrae.com')), None)
+        self.assertIs(router.query(url2tuple('https://infrae.com/docs')), None)
+
+    def test_router_prefix_urls(self):
+        """URLs are remembered by the part of their path that can match
+        a host.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)]),
+                VirtualHost(
+                    'http://infrae.com/docs',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+
+        router = get_router(service)
+        for url in ('http://infrae.com/docs/silva/index',
+                    'http://infrae.com/docs/index?page=2',
+                    'http://infrae.com/docs'):
+            self.assertEqual(
+                router.query_url(url).url, 'http://infrae.com/docs')
+        for url in ('http://infrae.com/about/index',
+                    'http://infrae.com/about#contact'):
+            self.assertEqual(router.query_url(url).url, 'http://infrae.com')
+        statistics = service.get_router_statistics()
+        self.assertEqual(statistics['known_hosts'], 2)
+        self.assertEqual(statistics['known_hosts_hits'], 3)
+
+    def test_host_invalid_wildcard(self):
+        """Wildcards are only allowed as the first label of a host.
+        """
+        service = queryUtility(IForestService)
+        for url in ('http://www.*.com', 'http://*', 'http://*.*.com'):
+            with self.assertRaises(ValueError):
+                service.set_hosts([
+                        VirtualHost(url, [], [Rewrite('/', '/root', None)])])
+
+    def test_router_unknown_hosts(self):
+        """URLs are remembered by the router, with their host or as
+        unknown, until the hosts change.
+        """
+        service = queryUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+
+        router = get_router(service)
+        host = router.query_url('http://infrae.com')
+        self.assertIsNot(host, None)
+        self.assertIs(router.query_url('http://infrae.com'), host)
+        self.assertIs(router.query_url('http://silvacms.org'), None)
+        self.assertIs(router.query_url('http://silvacms.org'), None)
+        # The URLs of pages share the entry of their host.
+        self.assertIs(router.query_url('http://infrae.com/docs/?page=2'), host)
+        self.assertIs(
+            router.query_url('http://silvacms.org/wp-login.php'), None)
+        self.assertEqual(
+            service.get_router_statistics(),
+            {'wildcard_hosts': 0,
+             'known_hosts': 1,
+             'known_hosts_hits': 2,
+             'known_hosts_misses': 4,
+             'unknown_hosts': 1,
+             'unknown_hosts_hits': 2,
+             'unknown_hosts_misses': 2})
+
+        service.set_hosts([
+                VirtualHost(
+                    'http://silvacms.org',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+        transaction.commit()
+        router = get_router(service)
+        self.assertIsNot(router.query_url('http://silvacms.org'), None)
+        self.assertIs(router.query_url('http://infrae.com'), None)
+
 
 class ServiceImportExportTestCase(unittest.TestCase):
     layer = FunctionalLayer
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+
+from zope.component import queryUtility
+
+from ..interfaces import IForestService
+from ..service import VirtualHost, Rewrite, SnapshotHosts
+from .. import snapshot
+from ..snapshot import dump, load, SnapshotError, MAGIC, HEADER
+from ..testing import FunctionalLayer
+from ..utils import url2tuple
+
+
+class SnapshotTestCase(unittest.TestCase):
+    layer = FunctionalLayer
+
+    def setUp(self):
+        self.root = self.layer.get_application()
+        factory = self.root.manage_addProduct['Silva']
+        factory.manage_addFolder('docs', 'Docs')
+        transaction.commit()
+        self.service = queryUtility(IForestService)
+        self.service.set_hosts([
+                VirtualHost(
+                    'http://infrae.com',
+                    ['http://www.infrae.com/site'],
+                    [Rewrite('/', '/root', None),
+                     Rewrite('/docs', '/root/docs', 'silva.ui.skin', False)]),
+                VirtualHost(
+                    'https://infrae.com/admin',
+                    [],
+                    [Rewrite('/', '/root', None)])])
+
+    def test_snapshot(self):
+        expected = self.service.get_query_hosts()
+        hosts = SnapshotHosts(load(dump(expected)))
+        self.assertEqual(len(hosts), 3)
+        self.assertEqual(sorted(hosts.iterkeys()), sorted(expected.keys()))
+
+        host = hosts[url2tuple('http://www.infrae.com/site')]
+        self.assertIs(host, hosts[url2tuple('http://www.infrae.com/site')])
+        self.assertIs(
+            host.rewrites,
+            hosts[url2tuple('http://infrae.com')].rewrites)
+        self.assertEqual(host.url, 'http://www.infrae.com/site')
+        rule, index = host.query(('site', 'docs', 'index'))
+        self.assertEqual(index, 2)
+        self.assertEqual(rule.url, 'http://www.infrae.com/site/docs')
+        self.assertEqual(rule.server_script, ['site', 'docs'])
+        self.assertEqual(rule.path, ('root', 'docs'))
+        self.assertEqual(rule.skin, 'silva.ui.skin')
+        self.assertEqual(rule.skin_enforce, False)
+        rule, index = host.query_path(('root', 'index'))
+        self.assertEqual(rule.url, 'http://www.infrae.com/site')
+        self.assertEqual(
+            [top_rule.url for top_rule in host.get_top_levels()],
+            ['http://www.infrae.com/site'])
+
+    def test_invalid(self):
+        with self.assertRaises(SnapshotError):
+            load('')
+        with self.assertRaises(SnapshotError):
+            load('invalid')
+        with self.assertRaises(SnapshotError):
+            load(HEADER.pack(MAGIC, 0, 0, 0, 0, 0, 0, 0))
+        with self.assertRaises(SnapshotError):
+            load(dump(self.service.get_query_hosts())[:-1])
+
+    def test_service(self):
+        transaction.commit()
+        self.service._p_deactivate()
+        self.assertIsNot(self.service._snapshot, None)
+        hosts = self.service.get_query_hosts()
+        self.assertTrue(isinstance(hosts, SnapshotHosts))
+        self.assertEqual(
+            self.service.query(url2tuple('https://infrae.com/admin')).url,
+            'https://infrae.com/admin')
+
+        # An unsupported snapshot is ignored, the hosts are compiled again.
+        self.service._snapshot.data = HEADER.pack(MAGIC, 0, 0, 0, 0, 0, 0, 0)
+        transaction.commit()
+        self.service._p_deactivate()
+        hosts = self.service.get_query_hosts()
+        self.assertFalse(isinstance(hosts, SnapshotHosts))
+        self.assertEqual(len(hosts), 3)
+        self.assertEqual(
+            self.service.query(url2tuple('https://infrae.com/admin')).url,
+            'https://infrae.com/admin')
+
+    def test_service_upgraded(self):
+        """Services saved by an older version don't have a snapshot.
+        Rewrites to deleted contents are skipped when the hosts are
+        compiled again.
+        """
+        del self.service._snapshot
+        self.root.manage_delObjects(['docs'])
+        transaction.commit()
+        self.service._p_deactivate()
+        hosts = self.service.get_query_hosts()
+        self.assertFalse(isinstance(hosts, SnapshotHosts))
+        self.assertEqual(len(hosts), 3)
+        host = self.service.query(url2tuple('http://infrae.com'))
+        self.assertEqual(
+            [top_rule.path for top_rule in host.get_top_levels()],
+            [('root',)])
+        rule, index = host.query(('docs', 'index'))
+        self.assertEqual(rule.url, 'http://infrae.com')
+
+
+class SnapshotFileTestCase(SnapshotTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous = snapshot.DIRECTORY
+        snapshot.DIRECTORY = self.directory
+        super(SnapshotFileTestCase, self).setUp()
+
+    def tearDown(self):
+        snapshot.DIRECTORY = self.previous
+        shutil.rmtree(self.directory)
+
+    def test_file(self):
+        transaction.commit()
+        filename = snapshot.get_filename(
+            self.service._p_jar.db().database_name,
+            self.service._p_oid,
+            self.service._p_serial)
+        # The file is written when the hosts are committed.
+        self.assertEqual(os.listdir(self.directory), [filename])
+
+        self.service._p_deactivate()
+        hosts = self.service.get_query_hosts()
+        self.assertTrue(isinstance(hosts, SnapshotHosts))
+        self.assertEqual(len(hosts), 3)
+        self.assertEqual(
+            self.service.query(url2tuple('https://infrae.com/admin')).url,
+            'https://infrae.com/admin')
+
+        # A missing file is written again.
+        os.unlink(os.path.join(self.directory, filename))
+        self.service._p_deactivate()
+        self.assertEqual(len(self.service.get_query_hosts()), 3)
+        self.assertEqual(os.listdir(self.directory), [filename])
+
+        # Changing the hosts replaces the file. Other connections, like
+        # other processes, map the new one.
+        connection = self.service._p_jar.db().open()
+        try:
+            other = connection.get(self.service._p_oid)
+            self.assertEqual(len(other.get_query_hosts()), 3)
+            self.service.set_hosts([])
+            transaction.commit()
+            connection.sync()
+            self.assertEqual(len(os.listdir(self.directory)), 1)
+            self.assertNotEqual(os.listdir(self.directory), [filename])
+            hosts = other.get_query_hosts()
+            self.assertTrue(isinstance(hosts, SnapshotHosts))
+            self.assertEqual(len(hosts), 0)
+        finally:
+            connection.close()
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SnapshotTestCase))
+    suite.addTest(unittest.makeSuite(SnapshotFileTestCase))
+    return suite
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import unittest
+
+from ..timing import Timings, Timer, NULL_TIMER
+
+
+class TimingsTestCase(unittest.TestCase):
+
+    def test_timings(self):
+        timings = Timings()
+        self.assertEqual(timings.get(), [])
+        timings.add('http://infrae.com', [('host', 0.002), ('rule', 0.001)])
+        timings.add('http://infrae.com', [('host', 0.004)])
+        self.assertEqual(
+            timings.get(),
+            [{'host': 'http://infrae.com', 'phase': 'host', 'count': 2,
+              'total': 6.0, 'average': 3.0, 'maximum': 4.0},
+             {'host': 'http://infrae.com', 'phase': 'rule', 'count': 1,
+              'total': 1.0, 'average': 1.0, 'maximum': 1.0}])
+        timings.clear()
+        self.assertEqual(timings.get(), [])
+
+    def test_timer(self):
+        timer = Timer()
+        timer.mark('host')
+        timer.mark('rule')
+        self.assertEqual(
+            [phase for phase, duration in timer.phases],
+            ['host', 'rule'])
+        # The null timer doesn't record anything.
+        NULL_TIMER.mark('host')
+        NULL_TIMER.finish('http://infrae.com')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TimingsTestCase))
+    return suite
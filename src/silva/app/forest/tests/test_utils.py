@@ -2,9 +2,11 @@
 # Copyright (c) 2011-2013 Infrae. All rights reserved.
 # See also LICENSE.txt
 
+import random
 import unittest
 
-from ..utils import url2tuple
+from ..utils import url2tuple, get_url_path, LRUCache, SymbolTable
+from ..utils import TupleMap, RadixMap, PrefixMap, DuplicateKeysError
 
 from zExceptions import BadRequest
 
@@ -31,16 +33,253 @@ class UtilsTestCase(unittest.TestCase):
             url2tuple('https://infrae.com:8081/manage'),
             ('https', 'infrae.com', '8081', 'manage'))
 
+        # URLs are normalized.
+        self.assertEqual(
+            url2tuple('http://Infrae.COM:80/docs'),
+            ('http', 'infrae.com', '80', 'docs'))
+        self.assertEqual(
+            url2tuple('HTTPS://infrae.com:443'),
+            ('https', 'infrae.com', '443'))
+        self.assertEqual(
+            url2tuple('http://admin@infrae.com'),
+            ('http', 'infrae.com', '80'))
+        self.assertEqual(
+            url2tuple(u'http://b\xfccher.example.com/docs'),
+            ('http', 'xn--bcher-kva.example.com', '80', 'docs'))
+        self.assertEqual(
+            url2tuple('http://b\xc3\xbccher.example.com'),
+            ('http', 'xn--bcher-kva.example.com', '80'))
+
         with self.assertRaises(BadRequest):
             url2tuple('http://infrae.com/../docs/admin')
         with self.assertRaises(BadRequest):
             url2tuple('http://infrae.com/docs/../../..')
 
+    def test_get_url_path(self):
+        self.assertEqual(get_url_path('http://infrae.com'), '')
+        self.assertEqual(
+            get_url_path('http://infrae.com:8080/docs/admin'),
+            '/docs/admin')
+        self.assertEqual(
+            get_url_path('https://infrae.com?page=1'),
+            '?page=1')
+        self.assertEqual(
+            get_url_path('http://infrae.com/docs;view?page=1#top'),
+            '/docs;view?page=1#top')
+        self.assertEqual(get_url_path('/docs/admin'), '/docs/admin')
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.set('infrae', 1), 1)
+        self.assertEqual(cache.set('silva', 2), 2)
+        self.assertEqual(cache.get('infrae'), 1)
+        cache.set('forest', 3)
+        # silva was the least recently used entry.
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('silva'), None)
+        self.assertEqual(cache.get('infrae'), 1)
+        self.assertEqual(cache.get('forest'), 3)
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('infrae', 42), 42)
+
+    def test_lru_cache_ttl(self):
+        cache = LRUCache(2, ttl=0)
+        cache.set('infrae', 1)
+        self.assertEqual(cache.get('infrae'), None)
+        self.assertEqual(cache.misses, 1)
+
+    def test_symbol_table(self):
+        symbols = SymbolTable()
+        root = symbols(''.join(['ro', 'ot']))
+        self.assertEqual(root, 'root')
+        self.assertIs(symbols(''.join(['r', 'oot'])), root)
+        path = symbols.tuple(['root', ''.join(['do', 'cs'])])
+        self.assertEqual(path, ('root', 'docs'))
+        self.assertIs(path[0], root)
+        self.assertIs(symbols.tuple(('root', 'docs')), path)
+        self.assertEqual(len(symbols), 3)
+
+
+class MapTestCase(unittest.TestCase):
+    keys = [
+        (),
+        ('docs',),
+        ('docs', 'admin', 'users'),
+        ('docs', 'admin', 'groups'),
+        ('docs', 'dev', 'api', 'python'),
+        ('downloads', 'silva'),
+        ]
+    queries = [
+        (),
+        ('docs',),
+        ('docs', 'admin'),
+        ('docs', 'admin', 'users', 'index'),
+        ('docs', 'admin', 'groups'),
+        ('docs', 'dev', 'api'),
+        ('docs', 'dev', 'api', 'python', 'index'),
+        ('downloads',),
+        ('downloads', 'silva', 'index'),
+        ('contact', 'index'),
+        ]
+
+    def build(self, factory, keys):
+        mapping = factory()
+        for key in keys:
+            self.assertEqual(mapping.add(key, '/'.join(key)), '/'.join(key))
+        return mapping
+
+    def test_radix_map(self):
+        mapping = self.build(RadixMap, self.keys[1:])
+        self.assertEqual(len(mapping), 5)
+        self.assertEqual(mapping[('docs', 'admin', 'users')], 'docs/admin/users')
+        self.assertEqual(
+            mapping.get(('docs', 'admin', 'users', 'index'), fallback=True),
+            ('docs/admin/users', 3))
+        self.assertEqual(
+            mapping.get(['docs', 'admin', 'index'], fallback=True),
+            ('docs', 1))
+        self.assertEqual(
+            mapping.get(('docs', 'admin', 'index')),
+            (None, 0))
+        self.assertEqual(mapping.top(), ['docs'])
+        with self.assertRaises(KeyError):
+            mapping.add(('docs', 'admin', 'users'), 'duplicate')
+        with self.assertRaises(KeyError):
+            mapping[('docs', 'admin')]
+        mapping.clear()
+        self.assertEqual(len(mapping), 0)
+        self.assertEqual(mapping.list(), [])
+
+    def test_prefix_map(self):
+        mapping = self.build(PrefixMap, self.keys[1:])
+        self.assertEqual(len(mapping), 5)
+        self.assertEqual(mapping[('docs', 'admin', 'users')], 'docs/admin/users')
+        self.assertEqual(
+            mapping.get(('docs', 'admin', 'users', 'index'), fallback=True),
+            ('docs/admin/users', 3))
+        self.assertEqual(
+            mapping.get(['docs', 'admin', 'index'], fallback=True),
+            ('docs', 1))
+        self.assertEqual(
+            mapping.get(('docs', 'admin', 'index')),
+            (None, 0))
+        self.assertEqual(mapping.top(), ['docs'])
+        with self.assertRaises(KeyError):
+            mapping.add(('docs', 'admin', 'users'), 'duplicate')
+        mapping.clear()
+        self.assertEqual(len(mapping), 0)
+        self.assertEqual(mapping.list(), [])
+        self.assertEqual(mapping.top(), [])
+
+    def test_iterators(self):
+        for factory in (TupleMap, RadixMap, PrefixMap):
+            mapping = self.build(factory, self.keys)
+            self.assertEqual(
+                sorted(mapping.iteritems()),
+                sorted((key, '/'.join(key)) for key in self.keys))
+            self.assertEqual(
+                sorted(mapping.itervalues()),
+                sorted('/'.join(key) for key in self.keys))
+            self.assertEqual(
+                sorted(mapping.iterprefix(('docs', 'admin'))),
+                [(('docs', 'admin', 'groups'), 'docs/admin/groups'),
+                 (('docs', 'admin', 'users'), 'docs/admin/users')])
+            self.assertEqual(
+                sorted(mapping.iterprefix(['docs', 'dev'])),
+                [(('docs', 'dev', 'api', 'python'), 'docs/dev/api/python')])
+            self.assertEqual(
+                sorted(mapping.iterprefix(('downloads', 'silva'))),
+                [(('downloads', 'silva'), 'downloads/silva')])
+            self.assertEqual(
+                list(mapping.iterprefix(('docs', 'user'))),
+                [])
+            self.assertEqual(
+                len(list(mapping.iterprefix(()))),
+                len(self.keys))
+
+    def test_empty(self):
+        for factory in (TupleMap, RadixMap, PrefixMap):
+            mapping = factory()
+            self.assertEqual(len(mapping), 0)
+            self.assertEqual(mapping.top(), [])
+            self.assertEqual(mapping.list(), [])
+            self.assertEqual(mapping.get(('docs',), fallback=True), (None, 0))
+
+    def assertEquivalent(self, expected, mapping, queries):
+        self.assertEqual(len(mapping), len(expected))
+        self.assertEqual(sorted(mapping.list()), sorted(expected.list()))
+        self.assertEqual(sorted(mapping.top()), sorted(expected.top()))
+        for query in queries:
+            for fallback in (True, False):
+                self.assertEqual(
+                    mapping.get(query, fallback=fallback),
+                    expected.get(query, fallback=fallback))
+
+    def test_equivalence(self):
+        for factory in (RadixMap, PrefixMap):
+            for keys in (self.keys, self.keys[1:], self.keys[2:]):
+                self.assertEquivalent(
+                    self.build(TupleMap, keys),
+                    self.build(factory, keys),
+                    self.queries)
+
+    def test_equivalence_random(self):
+        generator = random.Random(42)
+        pieces = ['root', 'docs', 'admin', 'silva', 'index']
+
+        def make_key(size):
+            return tuple(
+                generator.choice(pieces)
+                for index in range(generator.randint(0, size)))
+
+        for attempt in range(50):
+            keys = set(make_key(5) for index in range(10))
+            queries = [make_key(7) for index in range(50)]
+            expected = self.build(TupleMap, keys)
+            for factory in (RadixMap, PrefixMap):
+                self.assertEquivalent(
+                    expected, self.build(factory, keys), queries)
+
+    def test_from_sorted(self):
+        for keys in (self.keys, self.keys[1:], self.keys[2:]):
+            items = [(key, '/'.join(key)) for key in sorted(keys)]
+            expected = self.build(TupleMap, keys)
+            for factory in (TupleMap, RadixMap, PrefixMap):
+                mapping = factory.from_sorted(items)
+                self.assertEquivalent(expected, mapping, self.queries)
+                self.assertEqual(
+                    sorted(mapping.iteritems()),
+                    sorted(expected.iteritems()))
+
+    def test_from_sorted_duplicates(self):
+        items = [
+            (('docs',), 'first'),
+            (('docs',), 'second'),
+            (('docs', 'admin'), 'admin'),
+            (('silva',), 'first'),
+            (('silva',), 'second'),
+            (('silva',), 'third')]
+        for factory in (TupleMap, RadixMap, PrefixMap):
+            with self.assertRaises(DuplicateKeysError) as error:
+                factory.from_sorted(items)
+            self.assertEqual(
+                error.exception.keys,
+                [('docs',), ('silva',), ('silva',)])
+
+    def test_from_sorted_unsorted(self):
+        items = [(('silva',), 'silva'), (('docs',), 'docs')]
+        for factory in (TupleMap, RadixMap, PrefixMap):
+            with self.assertRaises(ValueError):
+                factory.from_sorted(items)
 
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(UtilsTestCase))
+    suite.addTest(unittest.makeSuite(MapTestCase))
     return suite
 
 
@@ -852,6 +852,67 @@ class MultipleHostsHostingTestCase(VirtualHostingTestCase):
             url.preview(),
             'http://frontend.localhost/info')
 
+    def test_urls_cache(self):
+        request = TestRequest(
+            application=self.root,
+            url='http://localhost',
+            headers=[('X-VHM-Url', 'http://localhost')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        plugin(request.method, request.path)
+        host = plugin.host
+
+        # Lookups are shared with the parent when no rule is below it.
+        rule, index = plugin.query_path(
+            host, ('root', 'docs', 'dev', 'resources'))
+        self.assertEqual(rule.url, 'http://localhost/manual')
+        self.assertEqual(index, 2)
+        self.assertIs(
+            plugin.query_path(host, ('root', 'docs', 'dev')),
+            plugin.query_path(host, ('root', 'docs', 'dev', 'resources')))
+        self.assertEqual(
+            plugin.query_path(host, ('root', 'docs', 'admin', 'index')),
+            (host.query_path(('root', 'docs', 'admin'))[0], 3))
+
+        url = getMultiAdapter((self.root.docs.dev, request), IContentURL)
+        self.assertEqual(url.url(), 'http://localhost/manual/dev')
+        self.assertEqual(url.url(), 'http://localhost/manual/dev')
+        self.assertEqual(url.url(relative=True), '/manual/dev')
+        self.assertEqual(
+            plugin.urls.values().count('http://localhost/manual/dev'), 1)
+
+    def test_get_urls(self):
+        request = TestRequest(
+            application=self.root,
+            url='http://localhost',
+            headers=[('X-VHM-Url', 'http://localhost')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        plugin(request.method, request.path)
+
+        contents = [
+            self.root,
+            self.root.docs,
+            self.root.docs.user,
+            self.root.docs.dev,
+            self.root.docs.dev.resources,
+            self.root.docs.admin]
+        paths = [content.getPhysicalPath() for content in contents]
+        for host in (None, 'http://admin.localhost'):
+            for relative in (False, True):
+                self.assertEqual(
+                    plugin.get_urls(paths, host=host, relative=relative),
+                    [getMultiAdapter((content, request), IContentURL).url(
+                            host=host, relative=relative)
+                     for content in contents])
+        self.assertEqual(
+            plugin.get_urls(['/root/docs/dev', '/root/docs/user']),
+            ['http://localhost/manual/dev', 'http://localhost/manual/user'])
+
+        brains = self.root.service_catalog(
+            meta_type='Silva Folder', path='/root/docs/dev')
+        self.assertEqual(
+            plugin.get_urls(brains),
+            [brain.getURL() for brain in brains])
+
     def test_backend(self):
         request = TestRequest(
             application=self.root,
@@ -874,6 +935,81 @@ class MultipleHostsHostingTestCase(VirtualHostingTestCase):
         self.assertEqual(method, 'index_html')
         self.assertEqual(path, ['admin', 'docs'])
 
+    def test_backend_full_url(self):
+        # The proxy can send the full URL instead of the host URL.
+        request = TestRequest(
+            application=self.root,
+            url='http://admin.localhost/docs/admin',
+            headers=[('X-VHM-Url', 'http://admin.localhost/docs/admin')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        root, method, path = plugin(request.method, request.path)
+        self.assertEqual(plugin.host.url, 'http://admin.localhost')
+        self.assertEqual(root, self.root)
+        self.assertEqual(method, 'index_html')
+        self.assertEqual(path, ['admin', 'docs'])
+
+
+class WildcardHostsHostingTestCase(VirtualHostingTestCase):
+
+    def setUp(self):
+        super(WildcardHostsHostingTestCase, self).setUp()
+        service = getUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://*.localhost/',
+                    [],
+                    [Rewrite('/', '/root/docs', None),
+                     Rewrite('/info', '/root', None)]),
+                VirtualHost(
+                    'http://admin.localhost/',
+                    [],
+                    [Rewrite('/', '/root', None)])
+                ])
+        service.activate()
+
+    def test_wildcard(self):
+        request = TestRequest(
+            application=self.root,
+            url='http://localhost/dev',
+            headers=[('X-VHM-Url', 'http://customer.localhost')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        root, method, path = plugin(request.method, request.path)
+        self.assertEqual(root, self.root.docs)
+        self.assertEqual(method, 'index_html')
+        self.assertEqual(path, ['dev'])
+        self.assertEqual(plugin.host.url, 'http://customer.localhost')
+
+        url = getMultiAdapter((self.root.docs.dev, request), IContentURL)
+        self.assertEqual(
+            url.url(),
+            'http://customer.localhost/dev')
+        self.assertEqual(
+            url.url(relative=True),
+            '/dev')
+
+        url = getMultiAdapter((self.root, request), IContentURL)
+        self.assertEqual(
+            url.url(),
+            'http://customer.localhost/info')
+        self.assertEqual(
+            url.url(host='http://other.customer.localhost'),
+            'http://other.customer.localhost/info')
+        self.assertEqual(
+            url.url(host='http://admin.localhost'),
+            'http://admin.localhost')
+
+    def test_exact(self):
+        request = TestRequest(
+            application=self.root,
+            url='http://admin.localhost/docs/admin',
+            headers=[('X-VHM-Url', 'http://admin.localhost')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        root, method, path = plugin(request.method, request.path)
+        self.assertEqual(root, self.root)
+        self.assertEqual(method, 'index_html')
+        self.assertEqual(path, ['admin', 'docs'])
+        self.assertEqual(plugin.host.url, 'http://admin.localhost')
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -882,4 +1018,5 @@ def test_suite():
     suite.addTest(unittest.makeSuite(OneRuleHostingTestCase))
     suite.addTest(unittest.makeSuite(MultipleRulesHostingTestCase))
     suite.addTest(unittest.makeSuite(MultipleHostsHostingTestCase))
+    suite.addTest(unittest.makeSuite(WildcardHostsHostingTestCase))
     return suite
@@ -5,18 +5,22 @@
 
 import unittest
 
+import transaction
 from zope.component import getUtility
 
 from silvatheme.standardissue.standardissue import IStandardIssueSkin
 from silvatheme.multiflex.multiflex import IMultiflexSkin
 from silva.core.layout.traverser import SET_SKIN_ALLOWED_FLAG
+from silva.core.services.interfaces import IMetadataService
 from Products.Silva.testing import TestRequest
 
 from infrae.wsgi.interfaces import IVirtualHosting
 
-from ..interfaces import IForestService
+from ..interfaces import IForestService, IForestRequest
 from ..service import VirtualHost, Rewrite
+from ..skins import get_publication_skin
 from ..testing import FunctionalLayer
+from ..utils import url2tuple
 
 
 class VirtualHostingTestCase(unittest.TestCase):
@@ -97,6 +101,82 @@ class VirtualHostingTestCase(unittest.TestCase):
         self.assertFalse(IStandardIssueSkin.providedBy(request))
         self.assertTrue(request.get(SET_SKIN_ALLOWED_FLAG, True))
 
+    def test_skin_request_declaration(self):
+        """Requests on the same rule share the same declaration.
+        """
+        requests = []
+        for attempt in range(2):
+            request = TestRequest(
+                application=self.root,
+                url='http://localhost/user/information',
+                headers=[('X-VHM-Url', 'http://localhost')])
+            plugin = request.query_plugin(
+                request.application, IVirtualHosting)
+            plugin(request.method, request.path)
+            self.assertTrue(IForestRequest.providedBy(request))
+            self.assertTrue(IMultiflexSkin.providedBy(request))
+            requests.append(request)
+        self.assertIs(
+            requests[0].__provides__,
+            requests[1].__provides__)
+
+    def test_skin_rule(self):
+        service = getUtility(IForestService)
+        host = service.query(url2tuple('http://localhost'))
+        rule, index = host.query(('user', 'information'))
+        self.assertEqual(rule.skin, 'Multiflex')
+        self.assertIs(rule.get_skin(), IMultiflexSkin)
+        rule, index = host.query(('docs', 'information'))
+        self.assertEqual(rule.skin, None)
+        self.assertIs(rule.get_skin(), None)
+
+    def test_skin_missing(self):
+        """A missing skin is not applied.
+        """
+        service = getUtility(IForestService)
+        service.set_hosts([
+                VirtualHost(
+                    'http://localhost/',
+                    [],
+                    [Rewrite('/', '/root', 'Missing')])
+                ])
+        host = service.query(url2tuple('http://localhost'))
+        rule, index = host.query(('information',))
+        self.assertIs(rule.get_skin(), None)
+
+        request = TestRequest(
+            application=self.root,
+            url='http://localhost/docs',
+            headers=[('X-VHM-Url', 'http://localhost')])
+        plugin = request.query_plugin(request.application, IVirtualHosting)
+        root, method, path = plugin(request.method, request.path)
+        self.assertEqual(root, self.root)
+        self.assertEqual(path, ['docs'])
+        self.assertFalse(IMultiflexSkin.providedBy(request))
+        self.assertTrue(request.get(SET_SKIN_ALLOWED_FLAG, True))
+
+    def test_skin_publication(self):
+        """The skin of a publication is remembered until it is
+        modified.
+        """
+        transaction.commit()
+        request = TestRequest(
+            application=self.root,
+            url='http://localhost/docs')
+        skin = get_publication_skin(self.root.docs, request)
+        self.assertIs(skin, IStandardIssueSkin)
+        self.assertIs(get_publication_skin(self.root.docs, request), skin)
+
+        binding = getUtility(IMetadataService).getMetadata(self.root.docs)
+        binding.setValues('silva-layout', {'skin': 'Multiflex'})
+        self.assertIs(
+            get_publication_skin(self.root.docs, request),
+            IMultiflexSkin)
+        transaction.commit()
+        self.assertIs(
+            get_publication_skin(self.root.docs, request),
+            IMultiflexSkin)
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+
+import os
+import threading
+import time
+
+# Timings are only collected if SILVA_FOREST_TIMINGS is set to on in
+# the environment.
+ENABLED = os.environ.get('SILVA_FOREST_TIMINGS', 'off').lower() in (
+    'on', 'true', 'yes', '1')
+
+
+class Timings(object):
+    """Time spent in each phase of the virtual hosting, aggregated per
+    virtual host.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def add(self, host, phases):
+        with self._lock:
+            host_phases = self._hosts.setdefault(host, {})
+            for phase, duration in phases:
+                stat = host_phases.get(phase)
+                if stat is None:
+                    host_phases[phase] = [1, duration, duration]
+                else:
+                    stat[0] += 1
+                    stat[1] += duration
+                    if duration > stat[2]:
+                        stat[2] = duration
+
+    def clear(self):
+        with self._lock:
+            self._hosts.clear()
+
+    def get(self):
+        """Return a list of timings, sorted by host and phase. Times
+        are in milliseconds.
+        """
+        result = []
+        with self._lock:
+            for host, phases in sorted(self._hosts.items()):
+                for phase, (count, total, maximum) in sorted(phases.items()):
+                    result.append({
+                            'host': host,
+                            'phase': phase,
+                            'count': count,
+                            'total': total * 1000,
+                            'average': total * 1000 / count,
+                            'maximum': maximum * 1000})
+        return result
+
+
+timings = Timings()
+
+
+class Timer(object):
+    """Measure the phases of one request.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.last = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def finish(self, host):
+        timings.add(host, self.phases)
+
+
+class NullTimer(object):
+    """Used when the timings are disabled.
+    """
+
+    def mark(self, phase):
+        pass
+
+    def finish(self, host):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+# Return a timer to measure a new request.
+if ENABLED:
+    start = Timer
+else:
+    def start():
+        return NULL_TIMER
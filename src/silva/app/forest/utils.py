@@ -2,6 +2,9 @@
 # Copyright (c) 2011-2013 Infrae. All rights reserved.
 # See also LICENSE.txt
 
+import collections
+import threading
+import time
 import urlparse
 
 from infrae.wsgi.utils import split_path_info
@@ -11,20 +14,177 @@ _marker = object()
 def path2tuple(path):
     return tuple(split_path_info(path))
 
-def url2tuple(url, strict=False):
+def get_url_path(url):
+    """Return the part of the URL following its host, without
+    parsing it.
+    """
+    start = url.find('://')
+    if start < 0:
+        start = 0
+    else:
+        start += 3
+    end = len(url)
+    for separator in '/?#':
+        index = url.find(separator, start, end)
+        if index >= 0:
+            end = index
+    return url[end:]
+
+
+class LRUCache(object):
+    """A thread-safe cache of a bounded size, discarding the least
+    recently used entries first. Entries can expire after ``ttl``
+    seconds.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._store = collections.OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._store.pop(key, _marker)
+            if entry is not _marker:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    # Mark the entry as the most recently used.
+                    self._store[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._store.pop(key, None)
+            self._store[key] = (value, expires)
+            while len(self._store) > self.size:
+                self._store.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._store)
+
+
+# Number of parsed URLs remembered by url2tuple.
+URL_CACHE_SIZE = 1024
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+def normalize_hostname(hostname):
+    hostname = hostname.lower()
+    try:
+        hostname.encode('ascii')
+    except UnicodeError:
+        try:
+            if isinstance(hostname, str):
+                hostname = hostname.decode('utf-8')
+            hostname = hostname.encode('idna')
+        except UnicodeError:
+            # Invalid hostname, it will not match anything.
+            pass
+    return hostname
+
+def parse_url(url, strict=False):
     info = urlparse.urlparse(url)
     if strict and info[4] or info[5]:
         raise ValueError(u'Invalid URL %s' % url)
-    scheme = info[0] or 'http'
-    hostname = info[1]
-    if ':' in hostname:
-        hostname, port = hostname.split(':', 1)
-    else:
-        if scheme == 'https':
-            port = '443'
-        else:
-            port = '80'
-    return (scheme, hostname, port, ) + path2tuple(info[2])
+    scheme = (info[0] or 'http').lower()
+    hostname, _, port = info[1].rpartition('@')[2].partition(':')
+    if not port:
+        port = DEFAULT_PORTS.get(scheme, '80')
+    return (scheme, normalize_hostname(hostname), port, ) + path2tuple(info[2])
+
+def split_wildcard(hostname):
+    """Return the labels following the wildcard of a host name like
+    *.example.com, or None if it is not a valid wildcard.
+    """
+    if not hostname.startswith('*.') or '*' in hostname[1:]:
+        return None
+    labels = hostname.split('.')[1:]
+    if not all(labels):
+        return None
+    return labels
+
+_parsed_urls = LRUCache(URL_CACHE_SIZE)
+
+def url2tuple(url, strict=False):
+    """Return a normalized tuple (scheme, hostname, port, path...)
+    for the given URL. Results are cached.
+    """
+    key = (url, strict)
+    result = _parsed_urls.get(key)
+    if result is None:
+        result = _parsed_urls.set(key, parse_url(url, strict))
+    return result
+
+
+class SymbolTable(object):
+    """Return a single instance for equal strings or tuples of
+    strings, so they are shared in memory and stored once in a
+    pickle.
+    """
+
+    def __init__(self):
+        self._symbols = {}
+
+    def __call__(self, value):
+        return self._symbols.setdefault(value, value)
+
+    def tuple(self, values):
+        return self(tuple(self(value) for value in values))
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+class DuplicateKeysError(KeyError):
+    """Raised when loading a map with duplicated keys. keys contains
+    all of them.
+    """
+
+    def __init__(self, keys):
+        super(DuplicateKeysError, self).__init__(keys)
+        self.keys = keys
+
+
+def add_all(mapping, items):
+    """Add all the (key, value) items to the mapping, and raise
+    DuplicateKeysError with all the duplicated keys if there are any.
+    """
+    duplicates = []
+    for key, value in items:
+        try:
+            mapping.add(key, value)
+        except KeyError:
+            duplicates.append(tuple(key))
+    if duplicates:
+        raise DuplicateKeysError(duplicates)
+    return mapping
+
+
+def iter_sorted(items):
+    """Iterate over the (key, value) items, raising ValueError if they
+    are not sorted by key.
+    """
+    previous = None
+    for key, value in items:
+        key = tuple(key)
+        if previous is not None and key < previous:
+            raise ValueError(u"Keys are not sorted.")
+        previous = key
+        yield key, value
 
 
 class TupleMap(object):
@@ -32,6 +192,44 @@ class TupleMap(object):
     def __init__(self):
         self.clear()
 
+    @classmethod
+    def from_sorted(cls, items):
+        """Create a map from (key, value) items sorted by key, in one
+        pass. DuplicateKeysError is raised with all the duplicated keys
+        if there are any.
+        """
+        mapping = cls()
+        duplicates = []
+        previous = None
+        # Pieces of the previous key and the store for each of them.
+        pieces = []
+        stores = [mapping._store]
+        for key, value in items:
+            key = tuple(key)
+            if previous is not None:
+                if key < previous:
+                    raise ValueError(u"Keys are not sorted.")
+                if key == previous:
+                    duplicates.append(key)
+                    continue
+            common = 0
+            limit = min(len(key), len(pieces))
+            while common < limit and key[common] == pieces[common]:
+                common += 1
+            del pieces[common:]
+            del stores[common + 1:]
+            store = stores[-1]
+            for piece in key[common:]:
+                store = store.setdefault(piece, {})
+                pieces.append(piece)
+                stores.append(store)
+            store[None] = value
+            mapping._len += 1
+            previous = key
+        if duplicates:
+            raise DuplicateKeysError(duplicates)
+        return mapping
+
     def clear(self):
         self._store = {}
         self._len = 0
@@ -78,7 +276,7 @@ class TupleMap(object):
         result = []
         current = self._store.items()
 
-        while not result:
+        while current and not result:
             after = []
             while current:
                 piece, value = current.pop()
@@ -90,18 +288,329 @@ class TupleMap(object):
         return result
 
     def list(self):
-        result = []
+        return list(self.itervalues())
 
-        def walk(level):
-            for piece, value in level.iteritems():
+    def _iteritems(self, store, prefix):
+        # Walk the store without recursion, keeping only one iterator
+        # per level.
+        stack = [(prefix, store.iteritems())]
+        while stack:
+            prefix, items = stack[-1]
+            for piece, value in items:
                 if piece is None:
-                    result.append(value)
+                    yield prefix, value
+                else:
+                    stack.append((prefix + (piece,), value.iteritems()))
+                    break
+            else:
+                stack.pop()
+
+    def iteritems(self):
+        """Iterate over the (key, value) pairs of the map.
+        """
+        return self._iteritems(self._store, ())
+
+    def itervalues(self):
+        stack = [self._store.iteritems()]
+        while stack:
+            for piece, value in stack[-1]:
+                if piece is None:
+                    yield value
                 else:
-                    walk(value)
+                    stack.append(value.iteritems())
+                    break
+            else:
+                stack.pop()
+
+    def iterprefix(self, prefix):
+        """Iterate over the (key, value) pairs of the map whose key
+        starts with prefix.
+        """
+        prefix = tuple(prefix)
+        store = self._store
+        for piece in prefix:
+            store = store.get(piece)
+            if store is None:
+                return iter(())
+        return self._iteritems(store, prefix)
 
-        walk(self._store)
+    def __getitem__(self, key):
+        value = self.get(key, _marker)[0]
+        if value is _marker:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return self._len
+
+
+class RadixNode(object):
+    """A node of a RadixMap. label is the sequence of pieces leading
+    to the node from its parent.
+    """
+    __slots__ = ('label', 'value', 'children')
+
+    def __init__(self, label, value=None, children=None):
+        self.label = label
+        self.value = value
+        self.children = children
+
+
+class RadixMap(object):
+    """Same API as TupleMap, but implemented as a radix trie: chains of
+    pieces without values nor branches are stored in one node, and nodes
+    uses slots instead of dictionaries.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    @classmethod
+    def from_sorted(cls, items):
+        """Create a map from (key, value) items sorted by key, like
+        TupleMap.from_sorted. The keys are verified to be sorted, but
+        added one by one.
+        """
+        return add_all(cls(), iter_sorted(items))
+
+    def clear(self):
+        self._root = RadixNode(())
+        self._len = 0
+
+    def add(self, key, value):
+        key = tuple(key)
+        node = self._root
+        position = 0
+        length = len(key)
+        while position < length:
+            piece = key[position]
+            child = None
+            if node.children is not None:
+                child = node.children.get(piece)
+            if child is None:
+                # Add the rest of the key as a new leaf.
+                if node.children is None:
+                    node.children = {}
+                node.children[piece] = RadixNode(key[position:], value)
+                self._len += 1
+                return value
+            label = child.label
+            common = 1
+            limit = min(len(label), length - position)
+            while common < limit and label[common] == key[position + common]:
+                common += 1
+            if common < len(label):
+                # Split the label of the child where the key diverges.
+                child.label = label[common:]
+                child = RadixNode(
+                    label[:common], children={child.label[0]: child})
+                node.children[piece] = child
+            node = child
+            position += common
+        if node.value is not None:
+            # There is already a value in the store.
+            raise KeyError(key)
+        node.value = value
+        self._len += 1
+        return value
+
+    def get(self, key, default=None, fallback=False):
+        if type(key) is not tuple:
+            key = tuple(key)
+        node = self._root
+        default_index = 0
+        position = 0
+        length = len(key)
+        while position < length:
+            if fallback and node.value is not None:
+                # Update default if fallback is on
+                default = node.value
+                default_index = position
+            if node.children is None:
+                return default, default_index
+            node = node.children.get(key[position])
+            if node is None:
+                return default, default_index
+            end = position + len(node.label)
+            if key[position:end] != node.label:
+                # The key diverges or ends in the middle of the label.
+                return default, default_index
+            position = end
+        if node.value is not None:
+            # Like TupleMap, an empty key matches with the index 1.
+            return node.value, length or 1
+        return default, default_index
+
+    def _walk(self, node=None, depth=0):
+        # Yield each node with its depth, without recursion.
+        stack = [(node or self._root, depth)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            if node.children is not None:
+                for child in node.children.itervalues():
+                    stack.append((child, depth + len(child.label)))
+
+    def _iteritems(self, node, key):
+        stack = [(node, key)]
+        while stack:
+            node, key = stack.pop()
+            if node.value is not None:
+                yield key, node.value
+            if node.children is not None:
+                for child in node.children.itervalues():
+                    stack.append((child, key + child.label))
+
+    def iteritems(self):
+        """Iterate over the (key, value) pairs of the map.
+        """
+        return self._iteritems(self._root, ())
+
+    def itervalues(self):
+        for node, depth in self._walk():
+            if node.value is not None:
+                yield node.value
+
+    def iterprefix(self, prefix):
+        """Iterate over the (key, value) pairs of the map whose key
+        starts with prefix.
+        """
+        prefix = tuple(prefix)
+        node = self._root
+        key = ()
+        length = len(prefix)
+        while len(key) < length:
+            position = len(key)
+            if node.children is None:
+                return iter(())
+            node = node.children.get(prefix[position])
+            if node is None:
+                return iter(())
+            # The prefix can end in the middle of the label.
+            end = min(position + len(node.label), length)
+            if node.label[:end - position] != prefix[position:end]:
+                return iter(())
+            key += node.label
+        return self._iteritems(node, key)
+
+    def top(self):
+        result = []
+        minimum = None
+        for node, depth in self._walk():
+            if node.value is None:
+                continue
+            if minimum is None or depth < minimum:
+                minimum = depth
+                result = [node.value]
+            elif depth == minimum:
+                result.append(node.value)
         return result
 
+    def list(self):
+        return list(self.itervalues())
+
+    def __getitem__(self, key):
+        value = self.get(key, _marker)[0]
+        if value is _marker:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return self._len
+
+
+class PrefixMap(object):
+    """Same API as TupleMap, but store the values in one dictionary per
+    key length. Lookups probe the key prefixes, from the longest length
+    used to the shortest one.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    @classmethod
+    def from_sorted(cls, items):
+        """Create a map from (key, value) items sorted by key, like
+        TupleMap.from_sorted. The keys are verified to be sorted, but
+        added one by one.
+        """
+        return add_all(cls(), iter_sorted(items))
+
+    def clear(self):
+        self._levels = {}
+        self._lengths = []
+        self._len = 0
+
+    def add(self, key, value):
+        key = tuple(key)
+        length = len(key)
+        level = self._levels.get(length)
+        if level is None:
+            level = self._levels[length] = {}
+            self._lengths = sorted(self._levels, reverse=True)
+        if level.get(key) is not None:
+            # There is already a value in the store.
+            raise KeyError(key)
+        level[key] = value
+        self._len += 1
+        return value
+
+    def get(self, key, default=None, fallback=False):
+        if type(key) is not tuple:
+            key = tuple(key)
+        length = len(key)
+        levels = self._levels
+        if not fallback:
+            level = levels.get(length)
+            if level is not None:
+                value = level.get(key)
+                if value is not None:
+                    # Like TupleMap, an empty key matches with the index 1.
+                    return value, length or 1
+            return default, 0
+        for candidate in self._lengths:
+            if candidate > length:
+                continue
+            value = levels[candidate].get(key[:candidate])
+            if value is not None:
+                if candidate == length:
+                    return value, length or 1
+                return value, candidate
+        return default, 0
+
+    def top(self):
+        if not self._lengths:
+            return []
+        return self._levels[self._lengths[-1]].values()
+
+    def list(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        """Iterate over the (key, value) pairs of the map.
+        """
+        for level in self._levels.itervalues():
+            for item in level.iteritems():
+                yield item
+
+    def itervalues(self):
+        for level in self._levels.itervalues():
+            for value in level.itervalues():
+                yield value
+
+    def iterprefix(self, prefix):
+        """Iterate over the (key, value) pairs of the map whose key
+        starts with prefix.
+        """
+        prefix = tuple(prefix)
+        length = len(prefix)
+        for candidate, level in self._levels.iteritems():
+            if candidate < length:
+                continue
+            for key, value in level.iteritems():
+                if key[:length] == prefix:
+                    yield key, value
+
     def __getitem__(self, key):
         value = self.get(key, _marker)[0]
         if value is _marker:
@@ -2,22 +2,40 @@
 # Copyright (c) 2011-2013 Infrae. All rights reserved.
 # See also LICENSE.txt
 
+import logging
 import urlparse
 
-from zope.interface import alsoProvides
 from Acquisition import aq_inner, aq_base, IAcquirer
 from five import grok
 
 from infrae.wsgi.interfaces import IPublicationAfterTraversal
 from infrae.wsgi.interfaces import IRequest, IVirtualHosting
 from infrae.wsgi.utils import traverse
+from silva.core.views.absoluteurl import AbsoluteURL
 
+from . import timing
 from . import utils
+from .router import get_router
 from .interfaces import IForestApplication, IForestHosting
-from .interfaces import IForestService, IForestRequest
+from .interfaces import IForestService
 
 from zExceptions import BadRequest, NotFound
 
+logger = logging.getLogger('silva.app.forest')
+
+
+def get_physical_path(item):
+    """Return the physical path of a path, as a tuple or a string, or
+    of a catalog brain.
+    """
+    if isinstance(item, tuple):
+        return item
+    if isinstance(item, basestring):
+        return tuple(item.rstrip('/').split('/'))
+    if hasattr(item, 'getPath'):
+        return tuple(item.getPath().rstrip('/').split('/'))
+    return tuple(item)
+
 
 class VirtualHosting(grok.MultiAdapter):
     grok.adapts(IForestApplication, IRequest)
@@ -29,15 +47,96 @@ class VirtualHosting(grok.MultiAdapter):
         self.request = request
         self.root = None
         self.host = None
+        self._router = None
+        self._timer = timing.start()
+        # Rules by (host, path), and URLs computed during the request.
+        self._paths = {}
+        self.urls = {}
         try:
             self.service = self._load_service()
         except BadRequest:
             self.service = None
+        self._timer.mark('service')
 
     def _load_service(self):
         return traverse(
             self.context.__silva__ + ('service_forest',), self.context)
 
+    @property
+    def router(self):
+        if self._router is None and self.service is not None:
+            self._router = get_router(self.service)
+        return self._router
+
+    def query_path(self, host, path):
+        key = (host, path)
+        result = self._paths.get(key)
+        if result is None:
+            parent = path[:-1]
+            if parent and not host.has_targets_below(parent):
+                # Same rule than the parent, share its lookup.
+                result = self.query_path(host, parent)
+            else:
+                result = host.query_path(path)
+            self._paths[key] = result
+        return result
+
+    def _get_pieces(self, host, path, relative):
+        # Return the pieces of the URL of path on host, or None.
+        rule, index = self.query_path(host, path[1:])
+        if rule is None:
+            return None
+        if relative:
+            return [''] + rule.server_script + list(path[index + 1:])
+        return [rule.url] + list(path[index + 1:])
+
+    def _get_url(self, host, path, relative):
+        pieces = self._get_pieces(host, path, relative)
+        if pieces is None:
+            logger.error(
+                u"No virtual host defined to compute URL for path %s.",
+                '/'.join(path))
+            return '/'.join(path)
+        if len(pieces) == 1 and relative:
+            return '/'
+        return '/'.join(pieces)
+
+    def get_urls(self, items, host=None, relative=False):
+        virtual_host = self.host
+        if host is not None:
+            virtual_host = None
+            if self.router is not None:
+                virtual_host = self.router.query_url(host)
+        urls = []
+        if virtual_host is None:
+            # Not in a virtual host, use the default Silva URLs.
+            adapter = AbsoluteURL(self.context, self.request)
+            for item in items:
+                urls.append(adapter._url(
+                        get_physical_path(item), relative=relative, host=host))
+            return urls
+
+        # URL of the parent of each path, if the path uses the same
+        # rule than its parent. Paths are grouped by parent.
+        parents = {}
+        for item in items:
+            path = get_physical_path(item)
+            parent = path[:-1]
+            prefix = parents.get(parent)
+            if prefix is None:
+                prefix = False
+                if parent[1:] and not virtual_host.has_targets_below(
+                    parent[1:]):
+                    pieces = self._get_pieces(virtual_host, parent, relative)
+                    if pieces is not None:
+                        prefix = '/'.join(pieces)
+                parents[parent] = prefix
+            if prefix is False:
+                urls.append(self._get_url(virtual_host, path, relative))
+            else:
+                urls.append(prefix + '/' + path[-1])
+        return urls
+
     def rewrite_url(self, base_url, original_url):
         base = (None, None)
         base_host = None
@@ -45,8 +144,7 @@ class VirtualHosting(grok.MultiAdapter):
             # Look for a rewrite rule host matching base_url
             base = urlparse.urlparse(base_url)
             if self.service is not None and self.host is not None:
-                base_host = self.service.query(
-                    utils.url2tuple(base_url))
+                base_host = self.router.query_url(base_url)
         original = urlparse.urlparse(original_url)
         if base_host is not None:
             # Look for full object path corresponding to the original url.
@@ -57,8 +155,7 @@ class VirtualHosting(grok.MultiAdapter):
                     u"This original URL is not in the virtual host.")
             original_path = original_rule.path + original_path[original_index:]
             # Compute the url using base_host and the original path.
-            base_rule, base_index = base_host.by_path.get(
-                original_path, fallback=True)
+            base_rule, base_index = base_host.query_path(original_path)
             if base_rule is None:
                 raise BadRequest(
                     u"This base URL is not in the virtual host.")
@@ -68,24 +165,31 @@ class VirtualHosting(grok.MultiAdapter):
     def __call__(self, method, path):
         root = self.context
         url = self.request.environ.get('HTTP_X_VHM_URL')
+        timer = self._timer
         if self.service is None:
             self.service = self._load_service()
-        if url:
-            url_key = utils.url2tuple(url)
-            assert IForestService.providedBy(self.service)
-            self.host = self.service.query(url_key)
-            if self.host is not None:
-                path_key = tuple(reversed(path))
-                rule, index = self.host.query(path_key)
-                if rule is not None:
-                    root = rule.apply(root, self.request)
+            timer.mark('service')
+        try:
+            if url:
+                assert IForestService.providedBy(self.service)
+                self.host = self.router.query_url(url)
+                timer.mark('host')
+                if self.host is not None:
+                    path_key = tuple(reversed(path))
+                    rule, index = self.host.query(path_key)
+                    timer.mark('rule')
+                    if rule is None:
+                        raise BadRequest(
+                            u"This URL is not in the virtual host.")
+                    root = rule.apply(root, self.request, timer)
                     self.root = root
                     if index:
                         path = path[:-index]
-                    alsoProvides(self.request, IForestRequest)
-                else:
-                    raise BadRequest(u"This URL is not in the virtual host.")
-
+        finally:
+            # Timings are collected per declared host, not per host
+            # name matching a wildcard.
+            timer.finish(
+                self.host.declared_url if self.host is not None else None)
         return root, method, path
 
 